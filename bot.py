@@ -1,13 +1,20 @@
 #!/usr/bin/env python3
 
 import asyncio
+import importlib
 import os
+import sys
+from typing import Optional
+
+# Imported first so the startup timer covers every other import.
+from musicbot.startup import startup_timer
 
 import discord
 from discord.ext import commands
 from dotenv import load_dotenv
 
 from logs import loggers
+from musicbot.general import initial_config
 
 logger = loggers.createLogger("main")
 
@@ -18,8 +25,12 @@ def loadEnvironmentVars() -> None:
 
 
 def getIntents() -> discord.Intents:
-    """Returns customized intents for the discord bot."""
-    customIntents = discord.Intents.all()
+    """Returns customized intents for the discord bot. Only what the music cog and the sync command use is enabled."""
+    customIntents = discord.Intents.none()
+    customIntents.guilds = True
+    customIntents.voice_states = True
+    customIntents.guild_messages = True
+    customIntents.message_content = True
 
     return customIntents
 
@@ -31,46 +42,112 @@ def getToken() -> str:
     return os.environ[tokenName]
 
 
-def createBot() -> commands.Bot:
-    """Creates and returns the discord bot."""
+class StartupMixin:
+    """Loads the cogs in setup_hook, on the bot's own event loop, and reports how long startup took once ready."""
+
+    async def setup_hook(self) -> None:
+        startup_timer.lap('login')
+        await loadCogs(self)
+        startup_timer.lap('cogs')
+
+    async def on_ready(self) -> None:
+        if any(name == 'gateway' for name, _, _ in startup_timer.laps):
+            return
+
+        startup_timer.lap('gateway')
+        logger.info(startup_timer.report())
+        startup_timer.check_budget(initial_config['startup']['budget_seconds'])
+
+
+class PhanBeatsBot(StartupMixin, commands.Bot):
+    pass
+
+
+class ShardedPhanBeatsBot(StartupMixin, commands.AutoShardedBot):
+    pass
+
+
+def createBot(shardIds: Optional[list[int]] = None, shardCount: Optional[int] = None) -> commands.Bot:
+    """Creates and returns the discord bot. An auto-sharded bot is created when sharding is enabled."""
     prefix = "!"
     logger.debug(f"Prefix set to {prefix}")
     customIntents = getIntents()
+    botOptions = dict(command_prefix=prefix, intents=customIntents, help_command=None, case_insensitive=True,
+                      application_id=1078497026041467051)
 
-    return commands.Bot(command_prefix=prefix, intents=customIntents, help_command=None, case_insensitive=True,
-                        application_id=1078497026041467051)
+    if not initial_config['sharding']['enabled'] and shardIds is None:
+        return PhanBeatsBot(**botOptions)
 
+    if shardIds is not None:
+        logger.debug(f"Running shards {shardIds} of {shardCount}")
+        botOptions['shard_ids'] = shardIds
+    if shardCount:
+        botOptions['shard_count'] = shardCount
 
-async def loadCogs(discordBot: commands.Bot) -> None:
-    """Loads all the cogs in the directory onto the bot."""
-    cogFiles = os.listdir("cogs")
+    return ShardedPhanBeatsBot(**botOptions)
 
-    for filename in cogFiles:
-        if filename.endswith(".py") and filename != "__init__.py" and filename != "sample.py":
-            cogName = filename[:-3]
 
-            logger.debug(f"Loading the {cogName} cog...")
-            try:
-                await discordBot.load_extension(f"cogs.{cogName}")
-                logger.debug(f"Loaded the {cogName} cog!")
-            except Exception:
-                logger.error(f"Failed to load the {cogName} cog!", exc_info=True)
+async def loadCog(discordBot: commands.Bot, cogName: str) -> bool:
+    logger.debug(f"Loading the {cogName} cog...")
+    try:
+        # The first import of a cog does the slow work, ex. scanning the library, so it runs on a worker thread
+        # alongside the other cogs. load_extension then executes the cog's module body a second time, which only
+        # redefines its classes because the modules it imports are already loaded, so module-level side effects in a
+        # cog would run twice.
+        await asyncio.to_thread(importlib.import_module, f"cogs.{cogName}")
+        await discordBot.load_extension(f"cogs.{cogName}")
+        logger.debug(f"Loaded the {cogName} cog!")
+        return True
+    except Exception:
+        logger.error(f"Failed to load the {cogName} cog!", exc_info=True)
+        return False
 
 
-if __name__ == "__main__":
+async def loadCogs(discordBot: commands.Bot) -> bool:
+    """Loads all the cogs in the directory onto the bot concurrently. Returns whether every cog loaded."""
+    cogNames = [filename[:-3] for filename in os.listdir("cogs")
+                if filename.endswith(".py") and filename != "__init__.py" and filename != "sample.py"]
+
+    return all(await asyncio.gather(*(loadCog(discordBot, cogName) for cogName in cogNames)))
+
+
+def runBot(shardIds: Optional[list[int]] = None, shardCount: Optional[int] = None) -> None:
+    """Creates, sets up and runs the discord bot until it is closed. The cogs are loaded once it has logged in."""
+    startup_timer.lap('imports')
     logger.info("Initializing bot...")
 
     loadEnvironmentVars()
 
-    bot = createBot()
-    asyncio.run(loadCogs(bot))
+    bot = createBot(shardIds, shardCount)
     token = getToken()
 
-
     @bot.command(name='sync')
     async def _sync(ctx):
         await ctx.bot.tree.sync()
         logger.info('Application commands have been synced.')
 
-
     bot.run(token)
+
+
+def checkStartup() -> bool:
+    """Loads the bot without connecting to discord. Returns whether every cog loaded within the startup budget."""
+    startup_timer.lap('imports')
+
+    async def setUp() -> bool:
+        async with createBot() as bot:
+            loaded = await loadCogs(bot)
+            startup_timer.lap('cogs')
+            return loaded
+
+    loaded = asyncio.run(setUp())
+    print(startup_timer.report())
+
+    return startup_timer.check_budget(initial_config['startup']['offline_budget_seconds']) and loaded
+
+
+if __name__ == "__main__":
+    # ex. python bot.py --check-startup, which exits with an error when startup is over budget.
+    if '--check-startup' in sys.argv:
+        sys.exit(0 if checkStartup() else 1)
+
+    runBot()
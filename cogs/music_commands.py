@@ -1,15 +1,26 @@
+import asyncio
 import math
+from typing import Optional
 
 import discord
 from discord import app_commands
-from discord.ext import commands
+from discord.ext import commands, tasks
 
 from logs import loggers
 from musicbot.audioplayer import VoiceState
-from musicbot.general import bot_name, bot_pfp_url
+from musicbot.export import create_sink, export_catalogue
+from musicbot.frameindex import get_frame_index
+from musicbot.general import bot_name, bot_pfp_url, initial_config
+from musicbot.governor import governor
+from musicbot.history import main_history
+from musicbot.hottier import hot_tier
 from musicbot.library import main_library
 from musicbot.playlists import main_playlists
-from musicbot.songs import Song, parse_id_from_raw_name
+from musicbot.query import main_query
+from musicbot.queueview import QueuePaginator
+from musicbot.similarity import get_similarity_index
+from musicbot.songs import Song, parse_id_from_raw_name, parse_timestamp
+from musicbot.sources import audio_cache, read_ahead_stats, warm_audio_cache
 
 logger = loggers.createLogger('main.music_commands')
 
@@ -18,7 +29,17 @@ class MusicCommands(commands.Cog):
     def __init__(self, bot: commands.Bot) -> None:
         self.bot = bot
         self.embed_color = 0xFFFFFF
-        self.voice_states = {}
+        self.voice_states: dict[int, VoiceState] = {}
+        self.caches_warmed = False
+
+        self.reap_idle_voice_states.change_interval(seconds=initial_config['voice']['reap_interval'])
+        self.reap_idle_voice_states.start()
+
+    async def cog_unload(self) -> None:
+        """Shuts down every voice state when the cog is unloaded."""
+        self.reap_idle_voice_states.cancel()
+        for guild_id in list(self.voice_states):
+            await self.release_voice_state(guild_id)
 
     def get_voice_state(self, ctx: discord.ext.commands.Context):
         """Creates a voice-state for the music bot."""
@@ -27,6 +48,76 @@ class MusicCommands(commands.Cog):
 
         return state
 
+    async def release_voice_state(self, guild_id: int) -> None:
+        """Stops tracking a guild's voice state and releases its task, ffmpeg process, connection and queue."""
+        voice_state = self.voice_states.pop(guild_id, None)
+        if voice_state:
+            await voice_state.shutdown()
+
+    def resource_counts(self) -> dict[str, int]:
+        """Returns counts of the live resources owned by the tracked voice states."""
+        states = list(self.voice_states.values())
+
+        return {
+            'voice_states': len(states),
+            'player_tasks': sum(1 for state in states if not state.audio_player.done()),
+            'voice_clients': sum(1 for state in states if state.is_connected),
+            'ffmpeg_processes': sum(1 for state in states if state.has_live_process),
+            'queued_songs': sum(len(state.songs) for state in states),
+        }
+
+    @tasks.loop(seconds=30)
+    async def reap_idle_voice_states(self) -> None:
+        """Shuts down voice states that have finished, lost their connection or gone idle."""
+        idle_guild_ids = [guild_id for guild_id, state in self.voice_states.items() if state.is_idle]
+        for guild_id in idle_guild_ids:
+            logger.debug(f"Reaping idle voice state for guild {guild_id}.")
+            try:
+                await self.release_voice_state(guild_id)
+            except Exception:
+                logger.error(f"Failed to reap the voice state for guild {guild_id}.", exc_info=True)
+
+        if idle_guild_ids:
+            logger.debug(f"Live voice resources: {self.resource_counts()}. Read-ahead: {dict(read_ahead_stats)}. "
+                         f"ffmpeg slots: {governor.stats()}")
+
+    @reap_idle_voice_states.before_loop
+    async def before_reap_idle_voice_states(self) -> None:
+        await self.bot.wait_until_ready()
+
+    async def warm_caches(self) -> None:
+        """Uses the play history to get the songs most likely to be requested ready ahead of time."""
+        main_library.set_popularity(main_history.song_plays)
+        audio_cache.seed_play_counts(main_history.song_plays)
+        hot_tier.seed_play_counts(main_history.song_plays, main_library.library)
+
+        # Built first, so autoplay doesn't have to wait for every top song to be preloaded.
+        await asyncio.to_thread(get_similarity_index)
+
+        top_song_ids = [song_id for song_id, _ in main_history.top_songs(initial_config['history']['warm_top_songs'])
+                        if song_id in main_library.library]
+        for song_id in top_song_ids:
+            await asyncio.to_thread(get_frame_index, song_id, main_library.library[song_id].filepath)
+
+        await warm_audio_cache(top_song_ids)
+        logger.debug(f"Warmed the caches for {len(top_song_ids)} songs. Audio cache: {audio_cache.stats()}, "
+                     f"hot tier: {hot_tier.stats()}")
+
+    @property
+    def owns_first_shard(self) -> bool:
+        """Returns whether this process runs shard 0. Work shared by every cluster, ex. syncing the playlist sheet, \
+        is only done by the cluster that owns it."""
+        shard_ids = getattr(self.bot, 'shard_ids', None)
+        return not shard_ids or 0 in shard_ids
+
+    async def sync_playlist_sheet(self) -> None:
+        """Sends the songs that changed since the last sync to the playlist sheet."""
+        try:
+            sink = await asyncio.to_thread(create_sink, 'sheet', 'temp/playlist_sheet.json')
+            await asyncio.to_thread(export_catalogue, main_library.library, 'sheet', sink)
+        except Exception:
+            logger.error("Failed to sync the playlist sheet.", exc_info=True)
+
     def interaction_check(self, interaction: discord.Interaction):
         """Prevents the bot from being used in DMs."""
         if not interaction.guild:
@@ -43,8 +134,34 @@ class MusicCommands(commands.Cog):
         ctx = await self.bot.get_context(interaction)
         guild_id = interaction.guild_id
 
-        if not self.voice_states[guild_id]:
+        voice_state = self.voice_states.get(guild_id)
+        if not voice_state or voice_state.is_finished:
+            # A finished state's player no longer takes songs off the queue, so it's replaced by a new one.
+            if voice_state:
+                await self.release_voice_state(guild_id)
             self.voice_states[guild_id] = self.get_voice_state(ctx)
+        else:
+            voice_state.touch()
+
+    @staticmethod
+    async def enqueue_song_ids(voice_state: VoiceState, song_ids: list[int]) -> None:
+        """Adds songs to the queue, yielding to the event loop regularly so a pending connection keeps progressing."""
+        for i, song_id in enumerate(song_ids, start=1):
+            voice_state.songs.put_nowait(Song(song_id))
+            if i % 100 == 0:
+                await asyncio.sleep(0)
+
+    async def send_queued_message(self, interaction: discord.Interaction, connection, text: str) -> None:
+        """Waits for a pending voice connection, then reports the queued songs or the connection failure."""
+        voice_state = self.voice_states[interaction.guild_id]
+        if connection and not await voice_state.wait_until_connected():
+            error = 'The music bot could not join your voice channel. Please try again.'
+            embed = discord.Embed(title='Oops!', description=error, color=0xFFFFFF)
+        else:
+            embed = discord.Embed(description=text, color=self.embed_color)
+
+        embed.set_author(name=bot_name, icon_url=bot_pfp_url)
+        await interaction.followup.send(embed=embed)
 
     @app_commands.command(name="join")
     async def _join(self, interaction: discord.Interaction):
@@ -54,28 +171,30 @@ class MusicCommands(commands.Cog):
         guild_id = interaction.guild_id
         voice_state = self.voice_states[guild_id]
 
-        # If there's no voice client yet, create one. Then, move.
-        # Bot movement always happens.
-        destination = interaction.user.voice.channel
-        if not voice_state.voice:
-            voice_state.voice = await destination.connect()
-            await voice_state.voice.move_to(destination)
+        # Acknowledge the interaction before the voice handshake, which can take longer than discord allows.
+        await interaction.response.defer()
 
-            text = f'The music bot has joined {destination.mention}!'
-            embed = discord.Embed(title='Music Bot Initialized', description=text, color=0xFFFFFF)
+        # If there's no voice client yet, create one. Otherwise, only the server owner can move the bot.
+        destination = interaction.user.voice.channel
+        if voice_state.is_connected and interaction.user.id != interaction.guild.owner_id:
+            text = f"The music bot is already in {voice_state.voice.channel.mention}."
+            embed = discord.Embed(title='Oops!', description=text, color=0xFFFFFF)
         else:
-            if interaction.user != interaction.guild.owner:
-                text = f"The music bot is already in {voice_state.voice.channel.mention}."
-                embed = discord.Embed(title='Oops!', description=text, color=0xFFFFFF)
-            else:
-                voice_state.voice = await destination.connect()
-                await voice_state.voice.move_to(destination)
+            moving = voice_state.is_connected
+            voice_state.connect(destination)
 
-                text = f'The music bot was moved to {destination.mention}!'
+            if not await voice_state.wait_until_connected() or voice_state.voice.channel != destination:
+                error = 'The music bot could not join your voice channel. Please try again.'
+                embed = discord.Embed(title='Oops!', description=error, color=0xFFFFFF)
+            else:
+                if moving:
+                    text = f'The music bot was moved to {destination.mention}!'
+                else:
+                    text = f'The music bot has joined {destination.mention}!'
                 embed = discord.Embed(title='Music Bot Initialized', description=text, color=0xFFFFFF)
 
         embed.set_author(name=bot_name, icon_url=bot_pfp_url)
-        await interaction.response.send_message(embed=embed)
+        await interaction.followup.send(embed=embed)
 
     @app_commands.command(name='leave')
     async def _leave(self, interaction: discord.Interaction):
@@ -87,9 +206,7 @@ class MusicCommands(commands.Cog):
             text = 'The music bot is not connected to any voice channel.'
             title = 'Oops'
         else:
-            await voice_state.stop()
-            del voice_state
-            self.voice_states[interaction.guild_id] = None
+            await self.release_voice_state(interaction.guild_id)
 
             text = 'The music bot has been disconnected.'
             title = 'Music Bot Disconnected'
@@ -109,22 +226,18 @@ class MusicCommands(commands.Cog):
         await self.ensure_voice_state(interaction)
         voice_state = self.voice_states[interaction.guild_id]
 
-        # Connect to a voice channel if the bot has not joined a channel yet.
-        # Bot movement sometimes happens.
-        if not voice_state.voice:
-            destination = interaction.user.voice.channel
-            voice_state.voice = await destination.connect()
-            await voice_state.voice.move_to(destination)
+        await interaction.response.defer()
+
+        # Connect to a voice channel in the background while the songs are queued.
+        # An open connection is reused.
+        connection = voice_state.connect(interaction.user.voice.channel) if not voice_state.is_connected else None
 
         song_id = parse_id_from_raw_name(selection)
         song = Song(song_id)
         await voice_state.songs.put(song)
 
         embed_text = f"Added `{song.title}` to the queue."
-        embed = discord.Embed(description=embed_text, color=self.embed_color)
-        embed.set_author(name=bot_name, icon_url=bot_pfp_url)
-
-        await interaction.response.send_message(embed=embed)
+        await self.send_queued_message(interaction, connection, embed_text)
 
     @play_group.command(name='all')
     async def _play_all(self, interaction: discord.Interaction) -> None:
@@ -132,26 +245,16 @@ class MusicCommands(commands.Cog):
         await self.ensure_voice_state(interaction)
         voice_state = self.voice_states[interaction.guild_id]
 
-        # Connect to a voice channel if the bot has not joined a channel yet.
-        # Bot movement sometimes happens.
-        if not voice_state.voice:
-            destination = interaction.user.voice.channel
-            voice_state.voice = await destination.connect()
-            await voice_state.voice.move_to(destination)
+        await interaction.response.defer()
 
-        all_song_ids = main_library.get_all_song_ids()
-        all_songs = []
-        for song_id in all_song_ids:
-            all_songs.append(Song(song_id))
+        # Connect to a voice channel in the background while the songs are queued.
+        # An open connection is reused.
+        connection = voice_state.connect(interaction.user.voice.channel) if not voice_state.is_connected else None
 
-        for song in all_songs:
-            await voice_state.songs.put(song)
+        await self.enqueue_song_ids(voice_state, main_library.get_all_song_ids())
 
         embed_text = f"Added all songs to the queue!"
-        embed = discord.Embed(description=embed_text, color=self.embed_color)
-        embed.set_author(name=bot_name, icon_url=bot_pfp_url)
-
-        await interaction.response.send_message(embed=embed)
+        await self.send_queued_message(interaction, connection, embed_text)
 
     @play_group.command(name='playlist')
     @app_commands.describe(selection='The playlist to play')
@@ -161,22 +264,60 @@ class MusicCommands(commands.Cog):
         await self.ensure_voice_state(interaction)
         voice_state = self.voice_states[interaction.guild_id]
 
-        # Connect to a voice channel if the bot has not joined a channel yet.
-        # Bot movement sometimes happens.
-        if not voice_state.voice:
-            destination = interaction.user.voice.channel
-            voice_state.voice = await destination.connect()
-            await voice_state.voice.move_to(destination)
+        await interaction.response.defer()
+
+        # Connect to a voice channel in the background while the songs are queued.
+        # An open connection is reused.
+        connection = voice_state.connect(interaction.user.voice.channel) if not voice_state.is_connected else None
 
         playlist = main_playlists.playlists_dict[selection]
-        for song in playlist.songs:
-            await voice_state.songs.put(song)
+        await self.enqueue_song_ids(voice_state, playlist.song_ids)
 
         embed_text = f"Added `{playlist.name}` to the queue!"
-        embed = discord.Embed(description=embed_text, color=self.embed_color)
-        embed.set_author(name=bot_name, icon_url=bot_pfp_url)
+        await self.send_queued_message(interaction, connection, embed_text)
+
+    @play_group.command(name='query')
+    @app_commands.describe(artist='Only songs by this artist', shorter_than='Only songs up to this long (ex. 3:00)',
+                           longer_than='Only songs at least this long (ex. 1:30)', first_id='Only songs from this ID',
+                           last_id='Only songs up to this ID')
+    @app_commands.autocomplete(artist=main_query.artist_autocomplete)
+    async def _play_query(self, interaction: discord.Interaction, artist: Optional[str] = None,
+                          shorter_than: Optional[str] = None, longer_than: Optional[str] = None,
+                          first_id: Optional[int] = None, last_id: Optional[int] = None) -> None:
+        """Plays every song in the library matching the given filters."""
+        await self.ensure_voice_state(interaction)
+        voice_state = self.voice_states[interaction.guild_id]
 
-        await interaction.response.send_message(embed=embed)
+        max_length = parse_timestamp(shorter_than) if shorter_than else None
+        min_length = parse_timestamp(longer_than) if longer_than else None
+        if (shorter_than and max_length is None) or (longer_than and min_length is None):
+            error = 'Lengths must be timestamps such as `90`, `1:30` or `1:02:30`. Please try again.'
+            embed = discord.Embed(title='Oops!', description=error, color=0xFFFFFF)
+            embed.set_author(name=bot_name, icon_url=bot_pfp_url)
+
+            return await interaction.response.send_message(embed=embed)
+
+        song_ids = main_query.select(artist=artist,
+                                     min_length=math.ceil(min_length) if min_length is not None else None,
+                                     max_length=math.floor(max_length) if max_length is not None else None,
+                                     first_id=first_id, last_id=last_id)
+        if not song_ids:
+            error = 'No songs in the library match those filters.'
+            embed = discord.Embed(title='Oops!', description=error, color=0xFFFFFF)
+            embed.set_author(name=bot_name, icon_url=bot_pfp_url)
+
+            return await interaction.response.send_message(embed=embed)
+
+        await interaction.response.defer()
+
+        # Connect to a voice channel in the background while the songs are queued.
+        # An open connection is reused.
+        connection = voice_state.connect(interaction.user.voice.channel) if not voice_state.is_connected else None
+
+        await self.enqueue_song_ids(voice_state, song_ids)
+
+        embed_text = f"Added {len(song_ids)} songs to the queue!"
+        await self.send_queued_message(interaction, connection, embed_text)
 
     # @play_group.command(name='youtube')
     # @app_commands.describe(selection='The YouTube link to a video or playlist')
@@ -311,42 +452,53 @@ class MusicCommands(commands.Cog):
 
         voice_state.skip()
 
-    @app_commands.command(name="queue")
-    @app_commands.describe(page='Enter page')
-    async def _queue(self, interaction: discord.Interaction, page: int):
-        """Shows the current song queue."""
+    @app_commands.command(name="seek")
+    @app_commands.describe(timestamp='Where to jump to in the current song (ex. 90, 1:30 or 1:02:30)')
+    async def _seek(self, interaction: discord.Interaction, timestamp: str):
+        """Jumps to a position in the current song."""
         await self.ensure_voice_state(interaction)
         voice_state = self.voice_states[interaction.guild_id]
 
-        if len(voice_state.songs) == 0:
-            error = 'Looks like the queue is empty.'
+        if not voice_state.is_playing:
+            error = 'No music is being played right now.'
             embed = discord.Embed(title='Oops!', description=error, color=0xFFFFFF)
             embed.set_author(name=bot_name, icon_url=bot_pfp_url)
 
             return await interaction.response.send_message(embed=embed)
 
-        items_per_page = 10
-        pages = math.ceil(len(voice_state.songs) / items_per_page)
+        seconds = parse_timestamp(timestamp)
+        if seconds is None or seconds >= voice_state.current.duration_seconds:
+            error = f'`{timestamp}` is not a valid position in `{voice_state.current.title}`.'
+            embed = discord.Embed(title='Oops!', description=error, color=0xFFFFFF)
+            embed.set_author(name=bot_name, icon_url=bot_pfp_url)
 
-        start = (page - 1) * items_per_page
-        end = start + items_per_page
+            return await interaction.response.send_message(embed=embed)
 
-        song_names = ""
-        artist_names = ""
-        for i, song in enumerate(voice_state.songs[start:end], start=start):
-            queue_num = i + 1
-            song_names += f"`{queue_num}.`  {song.title}\n"
-            artist_names += f"`{song.artist}`\n"
+        voice_state.seek(seconds)
 
-        embed = discord.Embed(title=f"Songs in Queue", color=0xFFFFFF)
+        text = f'Jumped to `{timestamp}` in `{voice_state.current.title}`.'
+        embed = discord.Embed(description=text, color=0xFFFFFF)
         embed.set_author(name=bot_name, icon_url=bot_pfp_url)
 
-        embed.add_field(name='Song', value=song_names)
-        embed.add_field(name='Artist', value=artist_names)
-        embed.set_footer(text=f"Viewing page {page}/{pages}")
-
         await interaction.response.send_message(embed=embed)
 
+    @app_commands.command(name="queue")
+    @app_commands.describe(page='The page to start on')
+    async def _queue(self, interaction: discord.Interaction, page: int = 1):
+        """Shows the current song queue."""
+        await self.ensure_voice_state(interaction)
+        voice_state = self.voice_states[interaction.guild_id]
+
+        if len(voice_state.songs) == 0:
+            error = 'Looks like the queue is empty.'
+            embed = discord.Embed(title='Oops!', description=error, color=0xFFFFFF)
+            embed.set_author(name=bot_name, icon_url=bot_pfp_url)
+
+            return await interaction.response.send_message(embed=embed)
+
+        paginator = QueuePaginator(voice_state.queue_pages, interaction, page - 1)
+        await interaction.response.send_message(embed=paginator.create_embed(), view=paginator)
+
     @app_commands.command(name='loop')
     async def _loop(self, interaction: discord.Interaction):
         """Toggles looping for the current song playing."""
@@ -372,6 +524,24 @@ class MusicCommands(commands.Cog):
 
         return await interaction.response.send_message(embed=embed)
 
+    @app_commands.command(name='autoplay')
+    async def _autoplay(self, interaction: discord.Interaction):
+        """Toggles playing similar songs automatically once the queue runs out."""
+        await self.ensure_voice_state(interaction)
+        voice_state = self.voice_states[interaction.guild_id]
+
+        voice_state.autoplay = not voice_state.autoplay
+
+        if voice_state.autoplay:
+            text = 'Similar songs will now play automatically when the queue runs out.'
+        else:
+            text = 'Autoplay has been turned off.'
+
+        embed = discord.Embed(description=text, color=0xFFFFFF)
+        embed.set_author(name=bot_name, icon_url=bot_pfp_url)
+
+        return await interaction.response.send_message(embed=embed)
+
     @app_commands.command(name='shuffle')
     async def _shuffle(self, interaction: discord.Interaction):
         """Shuffles the queue."""
@@ -395,7 +565,7 @@ class MusicCommands(commands.Cog):
     @app_commands.command(name='playlist')
     async def _playlist(self, interaction: discord.Interaction):
         """Shares a link to create a playlist."""
-        url_text = "https://docs.google.com/spreadsheets/d/1rbUAug8W87L8kLWXYb44r8JaXIqY6IvhQouidXJEDIQ/edit?usp=sharing"
+        url_text = f"https://docs.google.com/spreadsheets/d/{initial_config['export']['sheet_key']}/edit?usp=sharing"
 
         text = f"Go to the following google sheet and select your songs. Afterwards, DM Phan with your playlist name and the playlist copypasta." \
                f"\n\n{url_text}"
@@ -407,8 +577,11 @@ class MusicCommands(commands.Cog):
 
     @commands.Cog.listener()
     async def on_ready(self):
-        for guild in self.bot.guilds:
-            self.voice_states[guild.id] = None
+        if not self.caches_warmed:
+            self.caches_warmed = True
+            self.bot.loop.create_task(self.warm_caches())
+            if initial_config['export']['sheet_credentials'] and self.owns_first_shard:
+                self.bot.loop.create_task(self.sync_playlist_sheet())
         print('=====Bot is online and ready!=====')
 
 
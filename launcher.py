@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+import multiprocessing
+import os
+from pathlib import Path
+
+import requests
+
+import bot
+from logs import loggers
+from musicbot.general import CLUSTER_COUNT_ENV, CLUSTER_ENV, initial_config
+from musicbot.library import LIBRARY_INDEX_ENV, main_library, save_library_index
+
+logger = loggers.createLogger("main.launcher")
+
+libraryIndexPath = str(Path('temp') / 'library_index.json')
+
+
+def getShardCount(token: str) -> int:
+    """Returns the configured shard count, or the one recommended by discord if none is configured."""
+    shardCount = initial_config['sharding']['shard_count']
+    if shardCount:
+        return shardCount
+
+    response = requests.get("https://discord.com/api/v10/gateway/bot", headers={"Authorization": f"Bot {token}"},
+                            timeout=10)
+    response.raise_for_status()
+
+    return response.json()['shards']
+
+
+def getClusters(shardCount: int, clusterCount: int) -> list[list[int]]:
+    """Splits the shard IDs into contiguous clusters, one per process."""
+    clusterCount = max(1, min(clusterCount, shardCount))
+    clusterSize, remainder = divmod(shardCount, clusterCount)
+
+    clusters = []
+    start = 0
+    for i in range(clusterCount):
+        end = start + clusterSize + (1 if i < remainder else 0)
+        clusters.append(list(range(start, end)))
+        start = end
+
+    return clusters
+
+
+def buildLibraryIndex() -> str:
+    """Writes the index of the music library, which was scanned once on import, for every cluster to share."""
+    save_library_index(main_library.library, libraryIndexPath)
+    logger.debug(f"Wrote the library index for {len(main_library.library)} songs to {libraryIndexPath}")
+
+    return libraryIndexPath
+
+
+def runCluster(shardIds: list[int], shardCount: int, clusterCount: int) -> None:
+    """Runs a single cluster of shards. Used as the target of each cluster process."""
+    os.environ[CLUSTER_ENV] = str(shardIds[0])
+    os.environ[CLUSTER_COUNT_ENV] = str(clusterCount)
+    bot.runBot(shardIds, shardCount)
+
+
+if __name__ == "__main__":
+    bot.loadEnvironmentVars()
+    token = bot.getToken()
+
+    os.environ[LIBRARY_INDEX_ENV] = buildLibraryIndex()
+
+    shardCount = getShardCount(token)
+    clusters = getClusters(shardCount, initial_config['sharding']['clusters'])
+    logger.info(f"Launching {len(clusters)} clusters for {shardCount} shards...")
+
+    context = multiprocessing.get_context("spawn")
+    processes = []
+    for shardIds in clusters:
+        process = context.Process(target=runCluster, args=(shardIds, shardCount, len(clusters)), name=f"cluster-{shardIds[0]}")
+        process.start()
+        processes.append(process)
+
+    for process in processes:
+        process.join()
@@ -0,0 +1,394 @@
+#!/usr/bin/env python3
+
+"""Simulates many guilds playing music at once to measure how the bot scales.
+
+Every guild gets a real VoiceState and audio_player_task, driven against fake voice clients, channels and song
+sources. The fake voice client reads frames on its own thread like discord's audio player, and every fake song
+source holds a real governor slot and stands in for one ffmpeg process, so the audio path costs what it would in
+production minus the decoding itself. Nothing is sent to discord. The simulated songs are synthetic and none of \
+their files are opened, but the library is still loaded like at startup, which scans the music folder unless \
+PHANBEATS_LIBRARY_INDEX points at an index written by the launcher.
+
+ex. python loadtest.py --guilds 300 --duration 120
+"""
+
+import argparse
+import asyncio
+import itertools
+import random
+import statistics
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from pathlib import Path
+
+import discord
+
+from logs import loggers
+from musicbot import audioplayer
+from musicbot.audioplayer import VoiceState
+from musicbot.general import initial_config
+from musicbot.governor import Priority, governor
+from musicbot.history import PlayHistory
+from musicbot.library import main_library
+from musicbot.songs import Song, parse_id_from_raw_name
+from musicbot.sources import SongSource, frame_seconds
+
+logger = loggers.createLogger("main.loadtest")
+
+silentFrame = bytes(3840)  # 20ms of 48kHz stereo 16-bit PCM
+
+stats = Counter()
+statsLock = threading.Lock()
+players: list['FakeAudioPlayer'] = []
+
+
+class FakeProcess:
+    """Stands in for an ffmpeg process."""
+
+    alive = 0
+    peak = 0
+
+    def __init__(self) -> None:
+        self.returncode = None
+        with statsLock:
+            FakeProcess.alive += 1
+            FakeProcess.peak = max(FakeProcess.peak, FakeProcess.alive)
+
+    def poll(self):
+        return self.returncode
+
+    def kill(self) -> None:
+        with statsLock:
+            if self.returncode is None:
+                self.returncode = -9
+                FakeProcess.alive -= 1
+
+
+class FakePCMAudio(discord.AudioSource):
+    """Produces silent PCM frames for as long as the song lasts, like FFmpegPCMAudio without the decoding."""
+
+    def __init__(self, frameCount: int) -> None:
+        self.remaining = frameCount
+        self._process = FakeProcess()
+
+    def read(self) -> bytes:
+        if self.remaining <= 0:
+            return b''
+
+        self.remaining -= 1
+        return silentFrame
+
+    def cleanup(self) -> None:
+        self._process.kill()
+
+
+class FakeSongSource(SongSource):
+    @classmethod
+    async def create_source(cls, search: str, start: float = 0.0, restart: bool = False):
+        """Creates a source the way SongSource does for a song that isn't cached, minus ffmpeg."""
+        record = main_library.library[parse_id_from_raw_name(search)]
+        start = max(start, record.trim_start)
+
+        await governor.acquire_async(Priority.LIVE)
+        source = cls(FakePCMAudio(int((record.end_position - start) / frame_seconds)), start=start)
+        source.governor_priority = Priority.LIVE
+        stats['songs_started'] += 1
+
+        return source
+
+
+class FakeAudioPlayer(threading.Thread):
+    """Reads a source every 20ms on its own thread, like discord's AudioPlayer, and cleans it up afterwards. \
+    `speed` frames are read per tick."""
+
+    def __init__(self, source, after, loop: asyncio.AbstractEventLoop, speed: int) -> None:
+        super().__init__(daemon=True)
+        self.source = source
+        self.after = after
+        self.loop = loop
+        self.speed = speed
+        self.stopped = threading.Event()
+        self.paused = False
+
+    def run(self) -> None:
+        framesRead = 0
+        nextTick = time.perf_counter()
+        while not self.stopped.is_set():
+            if not self.paused:
+                for _ in range(self.speed):
+                    if not self.source.read():
+                        self.stopped.set()
+                        break
+                    framesRead += 1
+
+            nextTick += frame_seconds
+            time.sleep(max(0.0, nextTick - time.perf_counter()))
+
+        with statsLock:
+            stats['frames'] += framesRead
+            stats['playback_finished' if self.source.ended else 'playback_stopped'] += 1
+
+        self.after(None)
+        self.source.cleanup()
+
+
+class FakeVoiceClient:
+    def __init__(self, channel: 'FakeVoiceChannel', speed: int) -> None:
+        self.channel = channel
+        self.speed = speed
+        self.connected = True
+        self.player = None
+
+    def is_connected(self) -> bool:
+        return self.connected
+
+    def is_playing(self) -> bool:
+        return self.player is not None and self.player.is_alive() and not self.player.paused
+
+    def is_paused(self) -> bool:
+        return self.player is not None and self.player.is_alive() and self.player.paused
+
+    def play(self, source, after=None) -> None:
+        self.player = FakeAudioPlayer(source, after, asyncio.get_running_loop(), self.speed)
+        self.player.start()
+        players.append(self.player)
+
+    def stop(self) -> None:
+        if self.player:
+            self.player.stopped.set()
+
+    async def move_to(self, channel: 'FakeVoiceChannel') -> None:
+        self.channel = channel
+
+    async def disconnect(self) -> None:
+        self.stop()
+        self.connected = False
+        self.channel.guild.voice_client = None
+
+
+class FakeGuild:
+    def __init__(self, guildId: int) -> None:
+        self.id = guildId
+        self.voice_client = None
+
+
+class FakeVoiceChannel:
+    def __init__(self, guild: FakeGuild, connectLatency: float, speed: int) -> None:
+        self.guild = guild
+        self.connectLatency = connectLatency
+        self.speed = speed
+
+    async def connect(self) -> FakeVoiceClient:
+        await asyncio.sleep(self.connectLatency)
+        self.guild.voice_client = FakeVoiceClient(self, self.speed)
+        return self.guild.voice_client
+
+
+class FakeMessage:
+    ids = itertools.count(1)
+
+    def __init__(self, channel: 'FakeTextChannel') -> None:
+        self.id = next(FakeMessage.ids)
+        self.channel = channel
+
+    async def edit(self, **kwargs) -> None:
+        await asyncio.sleep(self.channel.apiLatency)
+        stats['api_calls'] += 1
+
+
+class FakeTextChannel:
+    def __init__(self, apiLatency: float) -> None:
+        self.apiLatency = apiLatency
+        self.last_message_id = None
+
+    async def send(self, **kwargs) -> FakeMessage:
+        await asyncio.sleep(self.apiLatency)
+        stats['api_calls'] += 1
+        message = FakeMessage(self)
+        self.last_message_id = message.id
+        return message
+
+
+class FakeBot:
+    def __init__(self, loop: asyncio.AbstractEventLoop) -> None:
+        self.loop = loop
+        self.channels = {}
+
+    def get_channel(self, channelId: int):
+        return self.channels.get(channelId)
+
+
+class FakeContext:
+    def __init__(self, guild: FakeGuild) -> None:
+        self.guild = guild
+
+
+def addSyntheticSongs(count: int, minSeconds: int, maxSeconds: int) -> list[int]:
+    """Adds songs to the in-memory library only. Their files don't exist, which the fake sources never notice."""
+    library = main_library.library
+    firstId = max(library.ids, default=0) + 1
+    for songId in range(firstId, firstId + count):
+        length = random.uniform(minSeconds, maxSeconds)
+        library.add(songId, f"Song {songId}", str(Path('loadtest') / f"Artist {songId % 50}"),
+                    f"Artist {songId % 50}", int(length), file_length=length)
+
+    return list(range(firstId, firstId + count))
+
+
+async def simulateGuild(voiceState: VoiceState, voiceChannel: FakeVoiceChannel, songIds: list[int],
+                        deadline: float, actionInterval: float) -> None:
+    """Plays, skips, shuffles and pages through the queue at random until the deadline."""
+    voiceState.connect(voiceChannel)
+    actions = ['play', 'skip', 'shuffle', 'queue']
+    weights = [4, 2, 1, 3]
+
+    while True:
+        await asyncio.sleep(min(random.expovariate(1 / actionInterval), max(0.0, deadline - time.monotonic())))
+        if time.monotonic() >= deadline:
+            break
+
+        action = random.choices(actions, weights)[0]
+        if action == 'play':
+            for songId in random.sample(songIds, random.randint(1, 5)):
+                voiceState.songs.put_nowait(Song(songId))
+        elif action == 'skip':
+            voiceState.skip()
+        elif action == 'shuffle':
+            voiceState.songs.shuffle()
+        else:
+            # Builds the embed the /queue command and its page buttons send, through the same page cache.
+            queuePages = voiceState.queue_pages
+            queuePages.create_embed(random.randrange(max(1, queuePages.page_count)))
+
+        voiceState.touch()
+        stats['commands'] += 1
+
+
+async def monitor(deadline: float, samples: dict[str, list], interval: float = 0.05) -> None:
+    """Samples the event-loop lag and the number of running ffmpeg processes."""
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples['lag'].append(time.perf_counter() - start - interval)
+        samples['processes'].append(FakeProcess.alive)
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] if ordered else 0.0
+
+
+async def runLoadTest(args: argparse.Namespace) -> dict:
+    loop = asyncio.get_running_loop()
+    bot = FakeBot(loop)
+    songIds = addSyntheticSongs(args.songs, args.min_song_seconds, args.max_song_seconds)
+
+    # Plays are logged to a throwaway history so the real one isn't polluted.
+    historyFolder = tempfile.TemporaryDirectory()
+    audioplayer.main_history = PlayHistory(Path(historyFolder.name) / 'play_history.bin')
+    audioplayer.SongSource = FakeSongSource
+
+    tracemalloc.start()
+    baselineMemory, _ = tracemalloc.get_traced_memory()
+    start = time.monotonic()
+    deadline = start + args.duration
+
+    voiceStates = []
+    workloads = []
+    for guildId in range(1, args.guilds + 1):
+        guild = FakeGuild(guildId)
+        bot.channels[guildId] = FakeTextChannel(args.api_latency)
+        initial_config['channels'][str(guildId)] = guildId
+
+        voiceState = VoiceState(bot, FakeContext(guild))
+        voiceChannel = FakeVoiceChannel(guild, args.connect_latency, args.speed)
+        voiceStates.append(voiceState)
+        workloads.append(simulateGuild(voiceState, voiceChannel, songIds, deadline, args.action_interval))
+
+    samples = {'lag': [], 'processes': []}
+    await asyncio.gather(monitor(deadline, samples), *workloads)
+
+    guildMemory, peakMemory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    elapsed = time.monotonic() - start
+
+    for voiceState in voiceStates:
+        stats['queue_page_hits'] += voiceState.queue_pages.hits
+        stats['queue_page_renders'] += voiceState.queue_pages.renders
+        await voiceState.shutdown()
+    # The players hand their last callbacks to the event loop, so it has to outlive them.
+    for player in players:
+        await asyncio.to_thread(player.join)
+    historyFolder.cleanup()
+
+    lag = samples['lag']
+    return {
+        'guilds': args.guilds,
+        'seconds': round(elapsed, 1),
+        'loop_lag_ms': {
+            'mean': round(statistics.fmean(lag) * 1000, 2) if lag else 0.0,
+            'p50': round(percentile(lag, 0.5) * 1000, 2),
+            'p99': round(percentile(lag, 0.99) * 1000, 2),
+            'max': round(max(lag, default=0.0) * 1000, 2),
+        },
+        'memory_per_guild_kb': round((guildMemory - baselineMemory) / args.guilds / 1024, 1),
+        'peak_memory_mb': round((peakMemory - baselineMemory) / 1024 ** 2, 1),
+        'ffmpeg_processes': {
+            'peak': FakeProcess.peak,
+            'mean': round(statistics.fmean(samples['processes']), 1) if samples['processes'] else 0.0,
+            'left_running': FakeProcess.alive,
+        },
+        'throughput_per_second': {
+            'commands': round(stats['commands'] / elapsed, 1),
+            'songs_started': round(stats['songs_started'] / elapsed, 2),
+            'audio_frames': round(stats['frames'] / elapsed, 1),
+            'api_calls': round(stats['api_calls'] / elapsed, 2),
+        },
+        'queue_pages': {
+            'hits': stats['queue_page_hits'],
+            'renders': stats['queue_page_renders'],
+        },
+        'songs': {
+            'started': stats['songs_started'],
+            'played_out': stats['playback_finished'],
+            'stopped': stats['playback_stopped'],
+        },
+        'governor': governor.stats()['live'],
+    }
+
+
+def parseArgs() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Simulates many guilds using the music player at once.")
+    parser.add_argument('--guilds', type=int, default=200)
+    parser.add_argument('--duration', type=float, default=60.0, help="seconds to run for")
+    parser.add_argument('--songs', type=int, default=1000, help="number of synthetic songs")
+    parser.add_argument('--min-song-seconds', type=int, default=20)
+    parser.add_argument('--max-song-seconds', type=int, default=60)
+    parser.add_argument('--action-interval', type=float, default=5.0,
+                        help="mean seconds between each guild's commands")
+    parser.add_argument('--speed', type=int, default=1, help="frames read per 20ms tick")
+    parser.add_argument('--api-latency', type=float, default=0.05)
+    parser.add_argument('--connect-latency', type=float, default=0.5)
+    parser.add_argument('--seed', type=int)
+
+    return parser.parse_args()
+
+
+def printReport(report: dict, indent: int = 0) -> None:
+    for key, value in report.items():
+        if isinstance(value, dict):
+            print(f"{' ' * indent}{key}:")
+            printReport(value, indent + 2)
+        else:
+            print(f"{' ' * indent}{key}: {value}")
+
+
+if __name__ == "__main__":
+    args = parseArgs()
+    random.seed(args.seed)
+
+    logger.info(f"Simulating {args.guilds} guilds for {args.duration} seconds...")
+    printReport(asyncio.run(runLoadTest(args)))
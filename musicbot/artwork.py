@@ -0,0 +1,117 @@
+import hashlib
+import io
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import TYPE_CHECKING, Optional
+
+from logs import loggers
+from musicbot.general import initial_config
+from musicbot.silence import get_file_stamp
+
+if TYPE_CHECKING:
+    from musicbot.library import SongTable
+
+logger = loggers.createLogger('main.artwork')
+
+thumbnail_folder = Path('temp') / 'artwork'
+artwork_index_path = Path('temp') / 'artwork_index.json'
+front_cover = 3  # the APIC picture type of a front cover
+
+
+def get_thumbnail_path(artwork_hash: str) -> Path:
+    return thumbnail_folder / f"{artwork_hash}.jpg"
+
+
+def extract_artwork(filepath: str) -> Optional[bytes]:
+    """Returns the embedded APIC artwork of a song, preferring the front cover."""
+    # Artwork is only extracted from new or changed songs, so most startups never need mutagen or Pillow.
+    from mutagen import MutagenError
+    from mutagen.id3 import ID3
+
+    try:
+        pictures = ID3(filepath).getall('APIC')
+    except MutagenError:
+        return None
+
+    if not pictures:
+        return None
+
+    front_covers = [picture for picture in pictures if picture.type == front_cover]
+    return (front_covers or pictures)[0].data
+
+
+def create_thumbnail(filepath: str) -> Optional[str]:
+    """Extracts a song's artwork and stores a downscaled copy named after the hash of the original image. \
+    Songs sharing the same artwork share one thumbnail, which is only ever created once."""
+    from PIL import Image, UnidentifiedImageError
+
+    data = extract_artwork(filepath)
+    if not data:
+        return None
+
+    artwork_hash = hashlib.sha1(data).hexdigest()
+    thumbnail_path = get_thumbnail_path(artwork_hash)
+    if thumbnail_path.exists():
+        return artwork_hash
+
+    size = initial_config['artwork']['thumbnail_size']
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            image = image.convert('RGB')
+            image.thumbnail((size, size))
+
+            # Written to a temporary name first so a half-written thumbnail is never served.
+            temp_path = thumbnail_path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+            image.save(temp_path, 'JPEG', quality=85)
+            os.replace(temp_path, thumbnail_path)
+    except (UnidentifiedImageError, OSError):
+        logger.error(f"Failed to create the artwork thumbnail for {filepath}", exc_info=True)
+        return None
+
+    return artwork_hash
+
+
+def load_artwork_index() -> dict[int, dict]:
+    """Returns the stored artwork as {song_id: {'hash', 'stamp'}}."""
+    try:
+        with open(artwork_index_path, 'r') as f:
+            return {int(song_id): entry for song_id, entry in json.load(f).items()}
+    except FileNotFoundError:
+        return {}
+
+
+def save_artwork_index(artwork_index: dict[int, dict]) -> None:
+    with open(artwork_index_path, 'w') as f:
+        json.dump(artwork_index, f)
+
+
+def update_artwork(library: 'SongTable') -> None:
+    """Creates thumbnails for every song that is new or has changed since the last scan, in parallel, and \
+    attaches every song's artwork to the library."""
+    thumbnail_folder.mkdir(parents=True, exist_ok=True)
+    artwork_index = load_artwork_index()
+
+    pending = {}
+    for song_id, record in library.items():
+        entry = artwork_index.get(song_id)
+        filepath = record.filepath
+        if entry and entry['stamp'] == get_file_stamp(filepath) and \
+                (entry['hash'] is None or get_thumbnail_path(entry['hash']).exists()):
+            continue
+        pending[song_id] = filepath
+
+    if pending:
+        logger.debug(f"Extracting artwork from {len(pending)} songs...")
+        with ThreadPoolExecutor(max_workers=initial_config['artwork']['workers']) as executor:
+            hashes = executor.map(create_thumbnail, pending.values())
+            for (song_id, filepath), artwork_hash in zip(pending.items(), hashes):
+                artwork_index[song_id] = {'hash': artwork_hash, 'stamp': get_file_stamp(filepath)}
+
+        save_artwork_index(artwork_index)
+
+    for song_id, entry in artwork_index.items():
+        if entry['hash'] and song_id in library:
+            library.set_artwork(song_id, entry['hash'])
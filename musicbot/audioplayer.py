@@ -1,6 +1,9 @@
 import asyncio
+import collections
 import itertools
 import random
+import time
+from typing import Optional
 
 import discord
 from async_timeout import timeout
@@ -8,7 +11,12 @@ from discord.ext import commands
 
 from logs import loggers
 from musicbot.general import initial_config
-from musicbot.sources import SongSource
+from musicbot.history import main_history
+from musicbot.nowplaying import NowPlayingMessage
+from musicbot.queueview import QueuePages
+from musicbot.similarity import get_similarity_index
+from musicbot.songs import Song
+from musicbot.sources import CrossfadeMixer, SongSource
 
 logger = loggers.createLogger('main.audioplayer')
 
@@ -18,6 +26,23 @@ class VoiceError(Exception):
 
 
 class SongQueue(asyncio.Queue):
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.listeners = []  # called with the first queue position that changed, ex. to invalidate rendered pages
+
+    def _changed(self, index: int) -> None:
+        for listener in self.listeners:
+            listener(index)
+
+    def _put(self, item):
+        super()._put(item)
+        self._changed(len(self._queue) - 1)
+
+    def _get(self):
+        item = super()._get()
+        self._changed(0)
+        return item
+
     def __getitem__(self, item):
         if isinstance(item, slice):
             return list(itertools.islice(self._queue, item.start, item.stop, item.step))
@@ -30,14 +55,23 @@ class SongQueue(asyncio.Queue):
     def __len__(self):
         return self.qsize()
 
+    def put_front(self, item):
+        """Puts a song at the front of the queue, ex. to hand it back when a fade into it is cancelled."""
+        self.put_nowait(item)
+        self._queue.rotate(1)
+        self._changed(0)
+
     def clear(self):
         self._queue.clear()
+        self._changed(0)
 
     def shuffle(self):
         random.shuffle(self._queue)
+        self._changed(0)
 
     def remove(self, index: int):
         del self._queue[index]
+        self._changed(index)
 
 
 class VoiceState:
@@ -46,19 +80,35 @@ class VoiceState:
         self.channel_id = initial_config['channels'][str(ctx.guild.id)]
         self.ctx = ctx
         self.channel = bot.get_channel(self.channel_id)
+        self.now_playing = NowPlayingMessage(self.channel)
 
         self.current = None
         self.voice = None
+        self._connection = None
         self.next = asyncio.Event()
         self.songs = SongQueue()
+        self.queue_pages = QueuePages(self.songs)
 
         self._loop = False
         self._volume = 0.5
+        self._seeking = False
 
-        self.audio_player = bot.loop.create_task(self.audio_player_task())
+        # Every song plays through a mixer, which fades into the next song when it's handed over in time. The current
+        # song is the one being heard, and the incoming song is the one handed over to fade in after it.
+        self.mixer: Optional[CrossfadeMixer] = None
+        self.crossfade_seconds = initial_config['crossfade']['seconds']
+        self.crossfade_lead = initial_config['crossfade']['lead_seconds']
+        self.incoming: Optional[Song] = None
+        self._handover: Optional[asyncio.Task] = None
 
-    def __del__(self):
-        self.audio_player.cancel()
+        self.autoplay = False
+        self.recent_song_ids = collections.deque(maxlen=initial_config['autoplay']['recent_songs'])
+
+        self.idle_timeout = initial_config['voice']['idle_timeout']
+        self.last_activity = time.monotonic()
+        self.closed = False
+
+        self.audio_player = bot.loop.create_task(self.audio_player_task())
 
     @property
     def loop(self):
@@ -67,6 +117,8 @@ class VoiceState:
     @loop.setter
     def loop(self, value: bool):
         self._loop = value
+        if value:
+            self.cancel_fade()
 
     @property
     def volume(self):
@@ -80,40 +132,244 @@ class VoiceState:
     def is_playing(self):
         return self.voice and self.current
 
+    @property
+    def is_connected(self) -> bool:
+        return self.voice is not None and self.voice.is_connected()
+
+    @property
+    def has_live_process(self) -> bool:
+        """Returns whether the current song still owns a running ffmpeg process."""
+        return bool(self.current and self.current.source and self.current.source.is_process_alive)
+
+    @property
+    def idle_for(self) -> float:
+        """Returns the number of seconds since the voice state last did anything."""
+        return time.monotonic() - self.last_activity
+
+    @property
+    def is_finished(self) -> bool:
+        """Returns whether the voice state can no longer play anything, ex. after its player timed out."""
+        return self.closed or self.audio_player.done()
+
+    @property
+    def is_idle(self) -> bool:
+        """Returns whether the voice state can be shut down without interrupting anyone."""
+        if self.is_finished:
+            return True
+
+        if self.voice and (self.voice.is_playing() or self.voice.is_paused()):
+            return False
+
+        if len(self.songs) > 0:
+            return False
+
+        return self.idle_for >= self.idle_timeout
+
+    def touch(self) -> None:
+        """Marks the voice state as active."""
+        self.last_activity = time.monotonic()
+
     async def audio_player_task(self):
         logger.debug(f"audio_player_task started")
         while True:
             self.next.clear()
+            self.touch()
+            restart = False
             try:
-                async with timeout(180):
+                async with timeout(self.idle_timeout):
                     # If the music player is not looping, get the next song. Otherwise, it keeps the old song.
-                    if self.current and self.loop:
+                    if self.current and self._seeking:
+                        logger.debug(f"Seeking within the current song. Keeping the same 'self.current' value.")
+                        restart = True
+                    elif self.current and self.loop:
                         logger.debug(f"The current song is now looping. Keeping the same 'self.current' value.")
                         self.current = self.current
+                        restart = True
+                    elif self.autoplay and self.recent_song_ids and len(self.songs) == 0:
+                        self.current = await self.pick_autoplay_song() or await self.songs.get()
                     else:
                         logger.debug(f"Waiting for a new song in queue...")
                         self.current = await self.songs.get()
                         logger.debug(f"New song found in queue!")
             except asyncio.TimeoutError:
-                # Clears the music player if it times out.
+                # Ends the music player if it times out. The voice state is reaped by its owner afterwards.
                 logger.debug(f"No song found. Timed out.")
-                self.bot.loop.create_task(self.stop())
                 self.current = None
-                logger.debug(f"Assuming audio_player_task ended here")
-                continue
+                return
 
             logger.debug(f"Exited try loop.")
-            source = await SongSource.create_source(self.current.raw_name)
+            if not await self.wait_until_connected():
+                logger.debug(f"Not connected to a voice channel. Dropping the current song.")
+                self.current = None
+                continue
+
+            self._seeking = False
+
+            source = await SongSource.create_source(self.current.raw_name, start=self.current.start_position,
+                                                    restart=restart)
+            self.current.start_position = 0.0
+            self.remember_song(self.current.song_id)
             self.current.source = source
             self.current.source.volume = self._volume
 
-            self.voice.play(self.current.source, after=self.play_next_song)
-
-            await self.channel.send(embed=self.current.embed)
+            self.next.clear()
+            self.play_source(source, self.current.end_position)
+            self.now_playing.update(self.current.embed, self.current.artwork_path)
 
+            # Songs handed over to fade in keep playing through the same mixer, so this waits for all of them.
             logger.debug(f"Waiting for song to finish...")
             await self.next.wait()
+
             logger.debug(f"Song finished!")
+            self.release_current()
+
+    def remember_song(self, song_id: int) -> None:
+        if not self.recent_song_ids or self.recent_song_ids[-1] != song_id:
+            self.recent_song_ids.append(song_id)
+
+    def play_source(self, source: SongSource, end_position: float) -> None:
+        """Starts playing a source in a new mixer."""
+        # Clears out a mixer that has run out but whose player hasn't quite stopped yet.
+        if self.voice.is_playing():
+            self.voice.stop()
+
+        mixer = self.mixer = CrossfadeMixer(source, end_position, self.crossfade_seconds, self.crossfade_lead,
+                                            self.on_fade_start, self.on_song_start)
+        self.voice.play(mixer, after=lambda error: self.bot.loop.call_soon_threadsafe(self.on_mixer_end, mixer,
+                                                                                        error))
+
+    def on_fade_start(self, mixer: CrossfadeMixer) -> None:
+        """Called from the player thread when the playing song is about to fade out."""
+        self.bot.loop.call_soon_threadsafe(self._start_fade, mixer)
+
+    def _start_fade(self, mixer: CrossfadeMixer) -> None:
+        if (mixer is self.mixer and self._handover is None and self.incoming is None and not self.loop
+                and not self._seeking):
+            self._handover = self.bot.loop.create_task(self.hand_over_next_song(mixer))
+
+    async def hand_over_next_song(self, mixer: CrossfadeMixer) -> None:
+        """Prepares the next song and hands it to the mixer, to fade in as the current song fades out. \
+        Cancelled if the current song ends, is restarted or starts looping first."""
+        try:
+            queued = not (self.autoplay and len(self.songs) == 0)
+            if queued:
+                # The song stays queued until it is handed over, so a cancelled handover never loses it.
+                song = await self.songs.get()
+                self.songs.put_front(song)
+            else:
+                song = await self.pick_autoplay_song()
+                if song is None:
+                    return
+
+            source = await SongSource.create_source(song.raw_name, start=song.start_position)
+            if queued and (len(self.songs) == 0 or self.songs[0] is not song):
+                # The queue was changed while the song was being prepared.
+                source.cleanup()
+                return
+
+            source.volume = self._volume
+            if not mixer.crossfade_to(source, song.end_position):
+                source.cleanup()
+                return
+
+            if queued:
+                self.songs.get_nowait()
+            song.source = source
+            self.incoming = song
+        except Exception:
+            logger.error(f"Failed to hand over the next song.", exc_info=True)
+        finally:
+            if self._handover is asyncio.current_task():
+                self._handover = None
+
+    def cancel_handover(self) -> None:
+        """Stops preparing the next song to fade in, if it's still being prepared."""
+        if self._handover is not None:
+            self._handover.cancel()
+            self._handover = None
+
+    def cancel_fade(self) -> None:
+        """Makes the current song play on to its end, ex. to restart or loop it. A song handed over to fade in goes \
+        back to the front of the queue, unless it has already started fading in, in which case it becomes the \
+        current song."""
+        self.cancel_handover()
+        if self.incoming is None:
+            return
+
+        if self.mixer.cancel_fade():
+            song, self.incoming = self.incoming, None
+            song.source.cleanup()
+            song.source = None
+            self.songs.put_front(song)
+        else:
+            self._switch_to_incoming(skipped=False)
+
+    def on_song_start(self, source: SongSource) -> None:
+        """Called from the player thread when a song handed to the mixer starts being heard."""
+        self.bot.loop.call_soon_threadsafe(self._show_song, source)
+
+    def _show_song(self, source: SongSource) -> None:
+        if self.incoming and self.incoming.source is source:
+            self._switch_to_incoming(skipped=False)
+
+    def _switch_to_incoming(self, skipped: bool) -> None:
+        """Makes the incoming song the current song, logging the one it replaces."""
+        main_history.log(self.ctx.guild.id, self.current.song_id, skipped=skipped)
+        # The mixer cleans up the source of the song it replaces.
+        self.current.source = None
+        self.current, self.incoming = self.incoming, None
+        self.remember_song(self.current.song_id)
+        self.now_playing.update(self.current.embed, self.current.artwork_path)
+
+    def on_mixer_end(self, mixer: CrossfadeMixer, error=None) -> None:
+        if mixer is not self.mixer or self.closed:
+            return
+
+        # A song handed over but never heard, ex. after /stop, is cleaned up along with the mixer.
+        self.cancel_handover()
+        self.incoming = None
+        if self.current and self.current.source and not self._seeking:
+            main_history.log(self.ctx.guild.id, self.current.song_id, skipped=not self.current.source.finished)
+        self.play_next_song(error)
+
+    async def pick_autoplay_song(self) -> Optional[Song]:
+        """Picks a song similar to the last one played, avoiding the songs played recently."""
+        # The index is normally built while the caches are warmed, but the first pick may still have to wait for it.
+        similarity_index = await asyncio.to_thread(get_similarity_index)
+        song_id = similarity_index.pick_next(self.recent_song_ids[-1], self.recent_song_ids)
+        if song_id is None:
+            return None
+
+        logger.debug(f"Autoplay picked song {song_id}.")
+        return Song(song_id)
+
+    def connect(self, destination: discord.VoiceChannel) -> asyncio.Task:
+        """Starts connecting to a voice channel in the background. An open connection is reused and moved if needed."""
+        if self._connection is None or self._connection.done():
+            self._connection = self.bot.loop.create_task(self._connect(destination))
+
+        return self._connection
+
+    async def _connect(self, destination: discord.VoiceChannel) -> discord.VoiceClient:
+        voice = self.voice or destination.guild.voice_client
+        if voice and voice.is_connected():
+            if voice.channel != destination:
+                await voice.move_to(destination)
+        else:
+            voice = await destination.connect()
+
+        self.voice = voice
+        return voice
+
+    async def wait_until_connected(self) -> bool:
+        """Waits for any pending connection and returns whether the voice state is connected."""
+        if self._connection:
+            try:
+                await self._connection
+            except (asyncio.TimeoutError, discord.ClientException):
+                logger.error(f"Failed to connect to a voice channel.", exc_info=True)
+
+        return self.is_connected
 
     def play_next_song(self, error=None):
         if error:
@@ -122,8 +378,33 @@ class VoiceState:
         self.next.set()
 
     def skip(self):
-        if self.is_playing:
-            self.voice.stop()
+        if not self.is_playing:
+            return
+
+        # Once the next song has been handed to the mixer, only the song still being heard is cut.
+        if self.incoming is not None:
+            skipped = not self.mixer.is_fading
+            if self.mixer.skip():
+                self._switch_to_incoming(skipped=skipped)
+                return
+
+        self.voice.stop()
+
+    def seek(self, seconds: float) -> None:
+        """Restarts the current song at the given position, measured from the end of any leading silence."""
+        if not self.is_playing:
+            return
+
+        self.cancel_fade()
+        self.current.start_position = self.current.trim_start + seconds
+        self._seeking = True
+        self.voice.stop()
+
+    def release_current(self) -> None:
+        """Kills the ffmpeg process of the current song, if there is one."""
+        if self.current and self.current.source:
+            self.current.source.cleanup()
+            self.current.source = None
 
     async def stop(self):
         self.songs.clear()
@@ -134,3 +415,31 @@ class VoiceState:
             self.voice = None
 
         return
+
+    async def shutdown(self) -> None:
+        """Deterministically releases everything owned by the voice state."""
+        if self.closed:
+            return
+        self.closed = True
+
+        self.audio_player.cancel()
+        self.cancel_handover()
+        if self._connection:
+            self._connection.cancel()
+        try:
+            await self.audio_player
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            logger.error(f"audio_player_task failed before shutdown.", exc_info=True)
+
+        self.loop = False
+        self.now_playing.close()
+        try:
+            await self.stop()
+        finally:
+            self.voice = None
+            self.release_current()
+            self.current = None
+            self.incoming = None
+            logger.debug(f"Voice state for guild {self.ctx.guild.id} has been shut down.")
@@ -1,11 +1,12 @@
 import os
-import subprocess
 from pathlib import Path
 
-from pytube import YouTube, Playlist
+from musicbot.governor import Priority, run_ffmpeg
 
 
 def download(link: str):
+    from pytube import YouTube, Playlist
+
     print('Downloading your videos and converting them to mp3 files...')
 
     destinationPath = Path(r'C:\Users\creyn\Documents\Programming\Discord\phan-beats\temp')
@@ -35,7 +36,7 @@ def download(link: str):
             audio = video.streams.filter(only_audio=True)[1]
             audio.download(output_path=destination, filename=file_name)
 
-            subprocess.run(['ffmpeg', '-i', filepath, new_filepath])
+            run_ffmpeg(['ffmpeg', '-i', filepath, new_filepath], Priority.INGEST)
             os.remove(filepath)
 
         if not download_errors:
@@ -65,7 +66,7 @@ def download(link: str):
             print(f"{audio=}")
             audio.download(output_path=destination, filename=file_name)
 
-            subprocess.run(['ffmpeg', '-i', filepath, new_filepath])
+            run_ffmpeg(['ffmpeg', '-i', filepath, new_filepath], Priority.INGEST)
             os.remove(filepath)
 
     if not download_errors:
@@ -0,0 +1,285 @@
+import csv
+import hashlib
+import itertools
+import json
+import os
+import re
+import sys
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import TYPE_CHECKING, Iterable, Iterator
+
+from logs import loggers
+from musicbot.general import initial_config
+
+if TYPE_CHECKING:
+    from musicbot.library import SongTable
+
+logger = loggers.createLogger('main.export')
+
+versions_path = Path('temp') / 'library_versions.json'
+export_state_path = Path('temp') / 'export_state.json'
+catalogue_fields = ['song_id', 'title', 'artist', 'duration']
+
+
+def get_row_fingerprint(row: dict) -> str:
+    return hashlib.sha1(json.dumps(row, sort_keys=True).encode()).hexdigest()
+
+
+def get_catalogue_row(library: 'SongTable', song_id: int) -> dict:
+    """Returns the exported fields of a song."""
+    record = library[song_id]
+    return {'song_id': song_id, 'title': record.title, 'artist': record.artist, 'duration': record.duration_str}
+
+
+def track_versions(library: 'SongTable') -> None:
+    """Carries the library version counter over from the last scan. Songs whose exported fields changed, and songs \
+    that disappeared, get a new version, so exports can tell which rows changed since they last ran."""
+    try:
+        with open(versions_path, 'r') as f:
+            saved = json.load(f)
+    except FileNotFoundError:
+        saved = {'version': 0, 'rows': {}, 'deleted': {}}
+
+    version = saved['version']
+    saved_rows = {int(song_id): entry for song_id, entry in saved['rows'].items()}
+    deleted = {int(song_id): deleted_version for song_id, deleted_version in saved['deleted'].items()}
+
+    rows = {}
+    for row, song_id in enumerate(library.ids):
+        fingerprint = get_row_fingerprint(get_catalogue_row(library, song_id))
+        saved_fingerprint, row_version = saved_rows.get(song_id, (None, 0))
+        if fingerprint != saved_fingerprint:
+            version += 1
+            row_version = version
+            deleted.pop(song_id, None)
+
+        library.row_versions[row] = row_version
+        rows[song_id] = (fingerprint, row_version)
+
+    for song_id in saved_rows.keys() - rows.keys():
+        version += 1
+        deleted[song_id] = version
+
+    library.version = version
+
+    write_json(versions_path, {'version': version, 'rows': rows, 'deleted': deleted})
+
+    library.deleted_versions = deleted
+
+
+class CatalogueSink(ABC):
+    """Somewhere the catalogue is exported to. Rows are handed over in chunks as they are produced."""
+
+    @abstractmethod
+    def write_rows(self, rows: list[dict]) -> None:
+        pass
+
+    @abstractmethod
+    def delete_rows(self, song_ids: list[int]) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class CsvSink(CatalogueSink):
+    """Appends changes to a CSV file. Deleted songs are written as rows with only their ID and `deleted` set."""
+
+    def __init__(self, filepath: Path) -> None:
+        is_new = not filepath.exists()
+        self.file = open(filepath, 'a', newline='', encoding='utf-8')
+        self.writer = csv.DictWriter(self.file, fieldnames=catalogue_fields + ['deleted'])
+        if is_new:
+            self.writer.writeheader()
+
+    def write_rows(self, rows: list[dict]) -> None:
+        self.writer.writerows(rows)
+
+    def delete_rows(self, song_ids: list[int]) -> None:
+        self.writer.writerows({'song_id': song_id, 'deleted': 1} for song_id in song_ids)
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class JsonlSink(CatalogueSink):
+    """Appends changes to a JSON Lines file, one upsert or delete operation per line."""
+
+    def __init__(self, filepath: Path) -> None:
+        self.file = open(filepath, 'a', encoding='utf-8')
+
+    def write_rows(self, rows: list[dict]) -> None:
+        self.file.writelines(json.dumps({'op': 'upsert', **row}) + '\n' for row in rows)
+
+    def delete_rows(self, song_ids: list[int]) -> None:
+        self.file.writelines(json.dumps({'op': 'delete', 'song_id': song_id}) + '\n' for song_id in song_ids)
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class SheetClient(ABC):
+    """The spreadsheet operations the sheet sink needs, keyed by song ID."""
+
+    @abstractmethod
+    def upsert_rows(self, rows: list[list]) -> None:
+        pass
+
+    @abstractmethod
+    def delete_rows(self, song_ids: list[int]) -> None:
+        pass
+
+
+class LocalSheetClient(SheetClient):
+    """A stand-in for a real spreadsheet that keeps the sheet in a local JSON file."""
+
+    def __init__(self, filepath: Path) -> None:
+        self.filepath = filepath
+        try:
+            with open(filepath, 'r', encoding='utf-8') as f:
+                self.rows = {int(song_id): row for song_id, row in json.load(f).items()}
+        except FileNotFoundError:
+            self.rows = {}
+
+    def upsert_rows(self, rows: list[list]) -> None:
+        for row in rows:
+            self.rows[row[0]] = row
+        self.save()
+
+    def delete_rows(self, song_ids: list[int]) -> None:
+        for song_id in song_ids:
+            self.rows.pop(song_id, None)
+        self.save()
+
+    def save(self) -> None:
+        with open(self.filepath, 'w', encoding='utf-8') as f:
+            json.dump(dict(sorted(self.rows.items())), f)
+
+
+def get_first_row_number(a1_range: str) -> int:
+    """Returns the first row number of an A1 range, ex. 5 for "Sheet1!A5:D7"."""
+    return int(re.search(r'\d+', a1_range.rpartition('!')[2]).group())
+
+
+class GoogleSheetClient(SheetClient):
+    """Keeps the first worksheet of a Google Sheet in sync. The first column holds the song IDs."""
+
+    def __init__(self, spreadsheet_key: str, credentials_path: str) -> None:
+        import gspread
+
+        self.worksheet = gspread.service_account(filename=credentials_path).open_by_key(spreadsheet_key).sheet1
+        song_ids = self.worksheet.col_values(1)[1:]
+        self.row_numbers = {int(song_id): number for number, song_id in enumerate(song_ids, start=2) if song_id}
+
+    def upsert_rows(self, rows: list[list]) -> None:
+        updates = []
+        new_rows = []
+        for row in rows:
+            number = self.row_numbers.get(row[0])
+            if number:
+                updates.append({'range': f"A{number}:D{number}", 'values': [row]})
+            else:
+                new_rows.append(row)
+
+        if updates:
+            self.worksheet.batch_update(updates)
+        if new_rows:
+            # Sheets appends after the last row of the table it finds, which may not be right after the known rows.
+            response = self.worksheet.append_rows(new_rows)
+            first_number = get_first_row_number(response['updates']['updatedRange'])
+            for number, row in enumerate(new_rows, start=first_number):
+                self.row_numbers[row[0]] = number
+
+    def delete_rows(self, song_ids: list[int]) -> None:
+        # Deleting from the bottom up keeps the remaining row numbers valid.
+        numbers = sorted((self.row_numbers.pop(song_id) for song_id in song_ids if song_id in self.row_numbers),
+                         reverse=True)
+        for number in numbers:
+            self.worksheet.delete_rows(number)
+            self.row_numbers = {song_id: row - 1 if row > number else row for song_id, row in self.row_numbers.items()}
+
+
+class SheetSink(CatalogueSink):
+    """Sends changes to a spreadsheet through a SheetClient."""
+
+    def __init__(self, client: SheetClient) -> None:
+        self.client = client
+
+    def write_rows(self, rows: list[dict]) -> None:
+        self.client.upsert_rows([[row[field] for field in catalogue_fields] for row in rows])
+
+    def delete_rows(self, song_ids: list[int]) -> None:
+        self.client.delete_rows(song_ids)
+
+
+def chunked(iterable: Iterable, size: int) -> Iterator[list]:
+    iterator = iter(iterable)
+    while chunk := list(itertools.islice(iterator, size)):
+        yield chunk
+
+
+def write_json(path: Path, data) -> None:
+    """Writes a JSON file through a temporary file, so a reader never sees it half written."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    with open(temp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(temp_path, path)
+
+
+def load_export_state() -> dict[str, int]:
+    try:
+        with open(export_state_path, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def export_catalogue(library: 'SongTable', sink_name: str, sink: CatalogueSink) -> int:
+    """Streams the songs that changed since the sink's last export to it in chunks. Returns the number of changes."""
+    state = load_export_state()
+    last_version = state.get(sink_name, 0)
+    chunk_size = initial_config['export']['chunk_size']
+
+    changed_ids = (song_id for row, song_id in enumerate(library.ids) if library.row_versions[row] > last_version)
+    changes = 0
+    try:
+        for chunk in chunked(changed_ids, chunk_size):
+            sink.write_rows([get_catalogue_row(library, song_id) for song_id in chunk])
+            changes += len(chunk)
+
+        deleted_ids = [song_id for song_id, version in library.deleted_versions.items() if version > last_version]
+        for chunk in chunked(deleted_ids, chunk_size):
+            sink.delete_rows(chunk)
+            changes += len(chunk)
+    finally:
+        sink.close()
+
+    state[sink_name] = library.version
+    write_json(export_state_path, state)
+
+    logger.info(f"Exported {changes} changed songs to {sink_name} (library version {library.version}).")
+
+    return changes
+
+
+def create_sink(sink_name: str, destination: str) -> CatalogueSink:
+    if sink_name == 'csv':
+        return CsvSink(Path(destination))
+    if sink_name == 'jsonl':
+        return JsonlSink(Path(destination))
+    if sink_name == 'sheet':
+        config = initial_config['export']
+        if config['sheet_credentials']:
+            return SheetSink(GoogleSheetClient(config['sheet_key'], config['sheet_credentials']))
+        return SheetSink(LocalSheetClient(Path(destination)))
+
+    raise ValueError(f"Unknown sink {sink_name}. Use csv, jsonl or sheet.")
+
+
+if __name__ == '__main__':
+    from musicbot.library import main_library
+
+    # ex. python -m musicbot.export csv temp/catalogue.csv
+    export_catalogue(main_library.library, f"{sys.argv[1]}:{sys.argv[2]}", create_sink(sys.argv[1], sys.argv[2]))
@@ -0,0 +1,187 @@
+import mmap
+import os
+import struct
+from array import array
+from functools import lru_cache
+from pathlib import Path
+from typing import Optional
+
+from logs import loggers
+
+logger = loggers.createLogger('main.frameindex')
+
+index_folder = Path('temp') / 'frame_index'
+index_resolution = 1.0  # seconds between index entries
+index_header = struct.Struct('<4sQqIIdI')
+index_magic = b'PBFI'
+
+# Bitrates in kbps, indexed by [is_mpeg1][bitrate_index] for Layer III.
+_bitrates = (
+    (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160, 0),
+    (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 0),
+)
+# Sample rates in Hz, indexed by [version_bits][sample_rate_index].
+_sample_rates = {
+    0b00: (11025, 12000, 8000),  # MPEG 2.5
+    0b10: (22050, 24000, 16000),  # MPEG 2
+    0b11: (44100, 48000, 32000),  # MPEG 1
+}
+
+
+class FrameIndex:
+    """A compact map from playback time to the byte offset of the MP3 frame playing at that time."""
+
+    def __init__(self, sample_rate: int, samples_per_frame: int, offsets: array, frames: array):
+        self.sample_rate = sample_rate
+        self.samples_per_frame = samples_per_frame
+        self.offsets = offsets
+        self.frames = frames
+
+    @property
+    def frame_duration(self) -> float:
+        return self.samples_per_frame / self.sample_rate
+
+    def locate(self, seconds: float) -> tuple[int, float]:
+        """Returns the byte offset of the frame at the given time and how far into that frame's entry the time is."""
+        if not self.offsets or seconds <= 0:
+            return (self.offsets[0] if self.offsets else 0), max(seconds, 0.0)
+
+        entry = min(int(seconds // index_resolution), len(self.offsets) - 1)
+        frame_start = self.frames[entry] * self.frame_duration
+
+        return self.offsets[entry], max(seconds - frame_start, 0.0)
+
+
+def parse_frame_header(header: bytes) -> Optional[tuple[int, int, int]]:
+    """Parses a Layer III frame header and returns (frame length, sample rate, samples per frame)."""
+    if len(header) < 4 or header[0] != 0xFF or (header[1] & 0xE0) != 0xE0:
+        return None
+
+    version_bits = (header[1] >> 3) & 0b11
+    layer_bits = (header[1] >> 1) & 0b11
+    bitrate_index = header[2] >> 4
+    sample_rate_index = (header[2] >> 2) & 0b11
+    padding = (header[2] >> 1) & 0b1
+
+    if version_bits not in _sample_rates or layer_bits != 0b01 or sample_rate_index == 0b11:
+        return None
+
+    is_mpeg1 = version_bits == 0b11
+    bitrate = _bitrates[is_mpeg1][bitrate_index] * 1000
+    if not bitrate:
+        return None
+
+    sample_rate = _sample_rates[version_bits][sample_rate_index]
+    samples_per_frame = 1152 if is_mpeg1 else 576
+    frame_length = (samples_per_frame // 8) * bitrate // sample_rate + padding
+
+    return frame_length, sample_rate, samples_per_frame
+
+
+def get_audio_start(data) -> int:
+    """Returns the offset of the first byte after any ID3v2 tag."""
+    if data[:3] != b'ID3':
+        return 0
+
+    size = 0
+    for byte in data[6:10]:
+        size = (size << 7) | (byte & 0x7F)
+    footer = 10 if data[5] & 0x10 else 0
+
+    return 10 + size + footer
+
+
+def build_frame_index(filepath: str) -> FrameIndex:
+    """Walks every frame header of an MP3 file and records an offset every index_resolution seconds."""
+    offsets = array('I')
+    frames = array('I')
+    sample_rate, samples_per_frame = 44100, 1152
+
+    with open(filepath, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        position = get_audio_start(data)
+        end = len(data)
+        frame_number = 0
+        next_entry_time = 0.0
+
+        while position + 4 <= end:
+            parsed = parse_frame_header(data[position:position + 4])
+            if not parsed:
+                # Resynchronise on the next possible frame header.
+                position = data.find(b'\xff', position + 1)
+                if position == -1:
+                    break
+                continue
+
+            frame_length, sample_rate, samples_per_frame = parsed
+
+            # A Xing/Info frame describes the stream but holds no audio, so it does not count towards the time.
+            if frame_number == 0 and not offsets and (b'Xing' in data[position:position + 64] or
+                                                     b'Info' in data[position:position + 64]):
+                position += frame_length
+                continue
+
+            frame_time = frame_number * samples_per_frame / sample_rate
+            if frame_time >= next_entry_time:
+                offsets.append(position)
+                frames.append(frame_number)
+                next_entry_time += index_resolution
+
+            frame_number += 1
+            position += frame_length
+
+    return FrameIndex(sample_rate, samples_per_frame, offsets, frames)
+
+
+def get_index_path(song_id: int) -> Path:
+    return index_folder / f"{song_id}.idx"
+
+
+def save_frame_index(song_id: int, filepath: str, frame_index: FrameIndex) -> None:
+    """Writes a frame index to the cache, stamped with the size and modification time of its file."""
+    stat = os.stat(filepath)
+    index_folder.mkdir(parents=True, exist_ok=True)
+
+    with open(get_index_path(song_id), 'wb') as f:
+        f.write(index_header.pack(index_magic, stat.st_size, stat.st_mtime_ns, frame_index.sample_rate,
+                                  frame_index.samples_per_frame, index_resolution, len(frame_index.offsets)))
+        frame_index.offsets.tofile(f)
+        frame_index.frames.tofile(f)
+
+
+def load_frame_index(song_id: int, filepath: str) -> Optional[FrameIndex]:
+    """Reads a cached frame index. Returns None if there is none or if its file has changed since."""
+    try:
+        stat = os.stat(filepath)
+        with open(get_index_path(song_id), 'rb') as f:
+            magic, size, mtime_ns, sample_rate, samples_per_frame, resolution, count = \
+                index_header.unpack(f.read(index_header.size))
+            if (magic, size, mtime_ns, resolution) != (index_magic, stat.st_size, stat.st_mtime_ns, index_resolution):
+                return None
+
+            offsets = array('I')
+            frames = array('I')
+            offsets.fromfile(f, count)
+            frames.fromfile(f, count)
+    except (FileNotFoundError, EOFError, struct.error):
+        return None
+
+    return FrameIndex(sample_rate, samples_per_frame, offsets, frames)
+
+
+def ensure_frame_index(song_id: int, filepath: str) -> None:
+    """Builds and caches a song's frame index if the cached one is missing or stale."""
+    if load_frame_index(song_id, filepath) is not None:
+        return
+
+    try:
+        save_frame_index(song_id, filepath, build_frame_index(filepath))
+    except (OSError, ValueError):
+        logger.error(f"Failed to build the frame index for {filepath}", exc_info=True)
+
+
+@lru_cache(maxsize=256)
+def get_frame_index(song_id: int, filepath: str) -> Optional[FrameIndex]:
+    """Returns a song's frame index, building it if needed."""
+    ensure_frame_index(song_id, filepath)
+
+    return load_frame_index(song_id, filepath)
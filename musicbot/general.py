@@ -2,11 +2,18 @@ from pathlib import Path
 
 import toml
 
+from musicbot.startup import startup_timer
+
 bot_name = "Phanbeats"
 bot_pfp_url = r"https://raw.githubusercontent.com/creynosa/images/main/beats%20by%20phan.png"
 last_song_id = 0
 configPath = str(Path('musicbot') / 'config.toml')
 
+# Set by the launcher in each cluster process to the cluster's first shard ID, ex. to give it its own files, and to
+# the number of clusters, ex. to split host-wide limits between them.
+CLUSTER_ENV = 'PHANBEATS_CLUSTER'
+CLUSTER_COUNT_ENV = 'PHANBEATS_CLUSTER_COUNT'
+
 
 def get_config() -> dict:
     """Reads and returns the general configs in the directory."""
@@ -21,4 +28,5 @@ def write_to_config(updated_config: dict):
         toml.dump(updated_config, f)
 
 
-initial_config = get_config()
+with startup_timer.phase('config'):
+    initial_config = get_config()
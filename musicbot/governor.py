@@ -0,0 +1,191 @@
+import asyncio
+import enum
+import os
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from logs import loggers
+from musicbot.general import CLUSTER_COUNT_ENV, initial_config
+
+logger = loggers.createLogger('main.governor')
+
+
+class Priority(enum.IntEnum):
+    LIVE = 0
+    PREFETCH = 1
+    INGEST = 2
+
+
+class TranscodeGovernor:
+    """Limits how many ffmpeg processes run at once. Each priority class has its own limit on top of the global \
+    one, and whenever a slot frees up the highest priority waiter gets it, so live playback is never starved by \
+    prefetching or ingest work. A limit of 0 means no limit, which is the default for live playback: a listener \
+    should never wait for another guild's song to end. \
+    Each process has its own governor. The configured limits are for the whole host, so each launcher cluster gets \
+    an equal share of them. The analysis commands are bounded by their own ingest_workers."""
+
+    def __init__(self, max_processes: int, class_limits: dict[Priority, int]) -> None:
+        self.max_processes = max_processes
+        self.class_limits = class_limits
+
+        self.active = Counter()
+        self.waiting = Counter()
+        self.acquired = Counter()
+        self.total_wait = Counter()
+        self.max_wait = Counter()
+
+        self._condition = threading.Condition()
+
+    def _can_start(self, priority: Priority) -> bool:
+        if self.max_processes and sum(self.active.values()) >= self.max_processes:
+            return False
+        if self.class_limits[priority] and self.active[priority] >= self.class_limits[priority]:
+            return False
+
+        return not any(self.waiting[other] for other in Priority if other < priority)
+
+    def _record_wait(self, priority: Priority, wait: float) -> None:
+        self.acquired[priority] += 1
+        self.total_wait[priority] += wait
+        self.max_wait[priority] = max(self.max_wait[priority], wait)
+
+    def try_acquire(self, priority: Priority) -> bool:
+        """Takes a slot if one is free right now."""
+        with self._condition:
+            if not self._can_start(priority):
+                return False
+
+            self.active[priority] += 1
+            self._record_wait(priority, 0.0)
+            return True
+
+    def acquire(self, priority: Priority) -> None:
+        """Blocks until a slot is free and takes it."""
+        start = time.monotonic()
+        with self._condition:
+            self.waiting[priority] += 1
+            try:
+                while not self._can_start(priority):
+                    self._condition.wait()
+            finally:
+                self.waiting[priority] -= 1
+
+            self.active[priority] += 1
+            wait = time.monotonic() - start
+            self._record_wait(priority, wait)
+
+        if priority == Priority.LIVE:
+            logger.warning(f"Live playback waited {wait:.2f}s for an ffmpeg slot. Consider raising the governor's "
+                           f"live or global max_processes.")
+
+    async def acquire_async(self, priority: Priority) -> None:
+        """Takes a slot without blocking the event loop."""
+        if self.try_acquire(priority):
+            return
+
+        waiter = asyncio.ensure_future(asyncio.to_thread(self.acquire, priority))
+        try:
+            await asyncio.shield(waiter)
+        except asyncio.CancelledError:
+            # The thread still takes a slot once one frees up, so it's handed straight back.
+            waiter.add_done_callback(lambda _: self.release(priority))
+            raise
+
+    def release(self, priority: Priority) -> None:
+        with self._condition:
+            self.active[priority] -= 1
+            self._condition.notify_all()
+
+    @contextmanager
+    def slot(self, priority: Priority):
+        self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release(priority)
+
+    def stats(self) -> dict[str, dict]:
+        """Returns the active and waiting processes and the queue-wait times of each priority class."""
+        stats = {}
+        with self._condition:
+            for priority in Priority:
+                acquired = self.acquired[priority]
+                stats[priority.name.lower()] = {
+                    'active': self.active[priority],
+                    'waiting': self.waiting[priority],
+                    'acquired': acquired,
+                    'average_wait': self.total_wait[priority] / acquired if acquired else 0.0,
+                    'max_wait': self.max_wait[priority],
+                }
+
+        return stats
+
+
+_unsupported_warnings: set[str] = set()
+
+
+def warn_unsupported(feature: str) -> None:
+    """Logs once per process that a configured kind of tuning can't be applied on this platform."""
+    if feature not in _unsupported_warnings:
+        _unsupported_warnings.add(feature)
+        logger.warning(f"Setting the {feature} of running processes isn't supported on this platform, so ffmpeg "
+                       f"processes keep whatever {feature} they were started with.")
+
+
+def get_cluster_share(limit: int) -> int:
+    """Returns this process's share of a host-wide limit. A limit of 0 stays unlimited."""
+    cluster_count = int(os.environ.get(CLUSTER_COUNT_ENV, 1))
+    return max(1, limit // cluster_count) if limit else 0
+
+
+def get_popen_kwargs(priority: Priority) -> dict:
+    """Returns the extra Popen arguments that lower a process's priority where it can only be set at spawn."""
+    if sys.platform == 'win32' and priority != Priority.LIVE:
+        if priority == Priority.INGEST:
+            return {'creationflags': subprocess.IDLE_PRIORITY_CLASS}
+        return {'creationflags': subprocess.BELOW_NORMAL_PRIORITY_CLASS}
+
+    return {}
+
+
+def tune_process(pid: int, priority: Priority) -> None:
+    """Applies the configured niceness and CPU affinity of a priority class to a running process."""
+    config = initial_config['governor'][priority.name.lower()]
+    try:
+        if config['nice']:
+            if hasattr(os, 'setpriority'):
+                os.setpriority(os.PRIO_PROCESS, pid, config['nice'])
+            else:
+                # ex. on Windows, where only processes started by run_ffmpeg get a lower priority, at spawn.
+                warn_unsupported('niceness')
+        if config['cpus']:
+            if hasattr(os, 'sched_setaffinity'):
+                os.sched_setaffinity(pid, config['cpus'])
+            else:
+                warn_unsupported('CPU affinity')
+    except OSError:
+        logger.debug(f"Could not tune process {pid} for {priority.name} work.", exc_info=True)
+
+
+def run_ffmpeg(args: list, priority: Priority = Priority.INGEST) -> bytes:
+    """Runs an ffmpeg command to completion within a governor slot and returns its standard output."""
+    with governor.slot(priority):
+        process = subprocess.Popen(args, stdout=subprocess.PIPE, **get_popen_kwargs(priority))
+        tune_process(process.pid, priority)
+        output, _ = process.communicate()
+
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, args, output)
+
+    return output
+
+
+governor = TranscodeGovernor(
+    get_cluster_share(initial_config['governor']['max_processes']),
+    {priority: get_cluster_share(initial_config['governor'][priority.name.lower()]['max_processes'])
+     for priority in Priority},
+)
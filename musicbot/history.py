@@ -0,0 +1,111 @@
+import os
+import struct
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from logs import loggers
+from musicbot.general import CLUSTER_ENV
+
+logger = loggers.createLogger('main.history')
+
+history_folder = Path('temp')
+history_name = 'play_history'
+
+# Each play is a fixed-size record: guild ID, song ID, timestamp and whether the song was skipped.
+play_record = struct.Struct('<QIdB')
+
+
+def get_history_path() -> Path:
+    """Returns the log this process appends to. Every launcher cluster has its own, so no two processes ever write \
+    to the same file."""
+    cluster = os.environ.get(CLUSTER_ENV)
+    return history_folder / (f"{history_name}.{cluster}.bin" if cluster else f"{history_name}.bin")
+
+
+class PlayHistory:
+    """An append-only log of every song played, with aggregates kept in memory for cheap queries. \
+    The aggregates cover the logs of every process, and each record is written off the event loop in one write."""
+
+    def __init__(self, filepath: Path) -> None:
+        self.filepath = filepath
+
+        self.song_plays = Counter()
+        self.song_skips = Counter()
+        self.guild_plays = Counter()
+        self.total_plays = 0
+        self.total_skips = 0
+
+        self.load()
+
+        self.filepath.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(self.filepath, 'ab', buffering=0)
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='play-history')
+
+    def get_log_paths(self) -> list[Path]:
+        """Returns this process's log and the logs written by the other processes."""
+        base_name = self.filepath.name.split('.')[0]
+        return sorted(set(self.filepath.parent.glob(f"{base_name}*.bin")) | {self.filepath})
+
+    def load(self) -> None:
+        """Rebuilds the aggregates from every log. A partially written last record is skipped. In this process's own \
+        log it's also cut off, so the records appended after it stay aligned. Other logs may still be written to, so \
+        they're left as they are."""
+        for path in self.get_log_paths():
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+            except FileNotFoundError:
+                continue
+
+            usable = len(data) - len(data) % play_record.size
+            for guild_id, song_id, _, skipped in play_record.iter_unpack(data[:usable]):
+                self._count(guild_id, song_id, bool(skipped))
+
+            if usable < len(data) and path == self.filepath:
+                logger.warning(f"Dropped {len(data) - usable} bytes of a partially written play record.")
+                with open(path, 'r+b') as f:
+                    f.truncate(usable)
+
+        logger.debug(f"Loaded {self.total_plays} plays from the play history.")
+    def _count(self, guild_id: int, song_id: int, skipped: bool) -> None:
+        self.song_plays[song_id] += 1
+        self.guild_plays[guild_id] += 1
+        self.total_plays += 1
+        if skipped:
+            self.song_skips[song_id] += 1
+            self.total_skips += 1
+
+    def log(self, guild_id: int, song_id: int, skipped: bool) -> None:
+        """Appends a play to the log in the background."""
+        self._writer.submit(self._write, play_record.pack(guild_id, song_id, time.time(), skipped))
+        self._count(guild_id, song_id, skipped)
+
+    def _write(self, record: bytes) -> None:
+        try:
+            self._file.write(record)
+        except OSError:
+            logger.error(f"Failed to write a play to {self.filepath}", exc_info=True)
+
+    def top_songs(self, n: int) -> list[tuple[int, int]]:
+        """Returns the n most played songs as (song_id, plays)."""
+        return self.song_plays.most_common(n)
+
+    def plays_per_guild(self) -> dict[int, int]:
+        return dict(self.guild_plays)
+
+    def skip_rate(self, song_id: int = None) -> float:
+        """Returns the fraction of plays that were skipped, for one song or for every song."""
+        if song_id is None:
+            return self.total_skips / self.total_plays if self.total_plays else 0.0
+
+        plays = self.song_plays[song_id]
+        return self.song_skips[song_id] / plays if plays else 0.0
+
+    def close(self) -> None:
+        self._writer.shutdown()
+        self._file.close()
+
+
+main_history = PlayHistory(get_history_path())
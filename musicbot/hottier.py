@@ -0,0 +1,238 @@
+import os
+import shutil
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from logs import loggers
+from musicbot.general import initial_config
+from musicbot.silence import get_file_stamp
+
+if TYPE_CHECKING:
+    from musicbot.library import SongTable
+
+logger = loggers.createLogger('main.hottier')
+
+# A temporary copy older than this was left behind by a process that died mid-copy.
+stale_copy_seconds = 3600
+
+
+class HotTier:
+    """A size-bounded copy of the most played songs on fast local storage, ex. an SSD in front of bulk storage. \
+    Songs are copied in once they've been played a few times, on a background thread, and the least recently \
+    played copies are evicted to stay within the size limit. Copies are byte-identical, so frame indexes built \
+    from the original files still apply. A copy's name holds the file stamp of the original it was copied from, so \
+    a copy of a file that has since changed is never played, and is dropped instead. \
+    Every shard cluster has its own HotTier over the same folder, so the folder is the shared state: a copy's \
+    modification time is when it was last played, and the folder is rescanned before evicting, so the size limit \
+    holds for the whole folder and not per process."""
+
+    def __init__(self, folder: Path, max_size: int, promote_after_plays: int, enabled: bool = True) -> None:
+        self.folder = folder
+        self.max_size = max_size
+        self.promote_after_plays = promote_after_plays
+        self.enabled = enabled
+
+        # song ID -> (copy path, file size), least recently played first
+        self.entries: OrderedDict[int, tuple[Path, int]] = OrderedDict()
+        self.play_counts = Counter()
+        self.pending: set[int] = set()
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.promotions = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='hot-tier')
+
+        if enabled:
+            self.load()
+
+    def get_path(self, song_id: int, stamp: list[int]) -> Path:
+        return self.folder / f"{song_id}-{stamp[0]}-{stamp[1]}.mp3"
+
+    def load(self) -> None:
+        """Picks up the copies already in the folder and removes any half-written ones left behind."""
+        self.folder.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            self._scan(remove_stale=True)
+
+        logger.debug(f"Loaded {len(self.entries)} songs ({self.size / 1024 ** 3:.2f}GB) from the hot tier.")
+
+    def _scan(self, remove_stale: bool = False) -> None:
+        """Rebuilds the entries from the folder, least recently played first, including the copies made by other \
+        processes. Must be called with the lock held."""
+        copies = []
+        now = time.time()
+        for path in self.folder.iterdir():
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+
+            if path.suffix == '.tmp':
+                # Another process may still be writing a recent one.
+                if remove_stale and now - stat.st_mtime > stale_copy_seconds:
+                    path.unlink(missing_ok=True)
+            elif path.suffix == '.mp3':
+                parts = path.stem.split('-')
+                if len(parts) == 3 and all(part.isdigit() for part in parts):
+                    copies.append((stat.st_mtime, int(parts[0]), path, stat.st_size))
+
+        self.entries = OrderedDict()
+        for _, song_id, path, size in sorted(copies):
+            if song_id in self.entries:
+                # The song was copied again after its file changed, so the older copy is stale.
+                self._delete(self.entries.pop(song_id)[0])
+            self.entries[song_id] = (path, size)
+        self.size = sum(size for _, size in self.entries.values())
+
+    def resolve(self, song_id: int, filepath: str) -> str:
+        """Returns the path to read a song from: its hot copy if it has one, or else the original file."""
+        if not self.enabled:
+            return filepath
+
+        # The copy is looked for on disk, since another process may have promoted or evicted it. Its modification
+        # time keeps the recency order across processes and restarts.
+        try:
+            hot_path = self.get_path(song_id, get_file_stamp(filepath))
+            os.utime(hot_path)
+            size = hot_path.stat().st_size
+        except FileNotFoundError:
+            with self._lock:
+                entry = self.entries.pop(song_id, None)
+                if entry:
+                    self.size -= entry[1]
+                self.misses += 1
+
+            # A copy of the song's file from before it changed is dropped, and promoted again on a later play.
+            if entry:
+                self._delete(entry[0])
+            return filepath
+
+        with self._lock:
+            _, old_size = self.entries.get(song_id, (None, 0))
+            self.size += size - old_size
+            self.entries[song_id] = (hot_path, size)
+            self.entries.move_to_end(song_id)
+            self.hits += 1
+
+        return str(hot_path)
+
+    def record_play(self, song_id: int, filepath: str) -> None:
+        """Counts a play of a song and promotes it in the background once it's played often enough."""
+        if not self.enabled:
+            return
+
+        with self._lock:
+            self.play_counts[song_id] += 1
+
+        self._consider(song_id, filepath)
+
+    def seed_play_counts(self, play_counts: dict[int, int], library: 'SongTable') -> None:
+        """Starts from known play counts, ex. the play history, and promotes the songs that already qualify, \
+        most played first."""
+        if not self.enabled:
+            return
+
+        with self._lock:
+            self.play_counts.update(play_counts)
+
+        for song_id, _ in Counter(play_counts).most_common():
+            if song_id in library:
+                self._consider(song_id, library[song_id].filepath)
+
+    def _consider(self, song_id: int, filepath: str) -> None:
+        with self._lock:
+            if song_id in self.entries or song_id in self.pending or \
+                    self.play_counts[song_id] < self.promote_after_plays:
+                return
+            self.pending.add(song_id)
+
+        self._executor.submit(self._promote, song_id, filepath)
+
+    def _promote(self, song_id: int, filepath: str) -> None:
+        temp_path = None
+        try:
+            stamp = get_file_stamp(filepath)
+            if stamp[0] > self.max_size:
+                return
+
+            # Another process may have promoted it already. Otherwise, it's written to a temporary name first so a
+            # half-copied song is never served. A file that changed mid-copy is promoted again on a later play.
+            hot_path = self.get_path(song_id, stamp)
+            if not hot_path.exists():
+                temp_path = hot_path.with_suffix(f".{os.getpid()}.tmp")
+                shutil.copyfile(filepath, temp_path)
+                if get_file_stamp(filepath) != stamp:
+                    temp_path.unlink()
+                    return
+                os.replace(temp_path, hot_path)
+        except OSError:
+            logger.error(f"Failed to promote song {song_id} to the hot tier.", exc_info=True)
+            if temp_path:
+                temp_path.unlink(missing_ok=True)
+            return
+        finally:
+            with self._lock:
+                self.pending.discard(song_id)
+
+        with self._lock:
+            self.promotions += 1
+
+        self._evict()
+
+    def _evict(self) -> None:
+        """Removes the least recently played copies until the whole folder fits within the size limit."""
+        with self._lock:
+            self._scan()
+
+            victims = []
+            size = self.size
+            for song_id, (path, entry_size) in self.entries.items():
+                if size <= self.max_size:
+                    break
+                victims.append(song_id)
+                size -= entry_size
+
+            paths = []
+            for song_id in victims:
+                path, entry_size = self.entries.pop(song_id)
+                paths.append(path)
+                self.size -= entry_size
+                self.evictions += 1
+
+        for path in paths:
+            self._delete(path)
+
+    @staticmethod
+    def _delete(path: Path) -> None:
+        try:
+            path.unlink(missing_ok=True)
+        except OSError:
+            # ex. on Windows, a file being played can't be deleted. It's picked up again on the next startup.
+            logger.debug(f"Could not delete the hot copy {path}.", exc_info=True)
+
+    def stats(self) -> dict[str, float]:
+        with self._lock:
+            return {
+                'songs': len(self.entries),
+                'size_gb': round(self.size / 1024 ** 3, 2),
+                'hits': self.hits,
+                'misses': self.misses,
+                'promotions': self.promotions,
+                'evictions': self.evictions,
+            }
+
+
+hot_tier = HotTier(
+    Path(initial_config['hot_tier']['path']),
+    int(initial_config['hot_tier']['max_size_gb'] * 1024 ** 3),
+    initial_config['hot_tier']['promote_after_plays'],
+    initial_config['hot_tier']['enabled'],
+)
@@ -1,98 +1,314 @@
+import itertools
+import json
 import math
 import os
 import re
+from array import array
 from pathlib import Path
-from typing import Optional
+from typing import TYPE_CHECKING, Optional
 
 import discord
 from discord import app_commands
-from mutagen.mp3 import MP3
 
 from logs import loggers
+from musicbot.artwork import get_thumbnail_path, update_artwork
+from musicbot.export import track_versions, write_json
+from musicbot.frameindex import ensure_frame_index
 from musicbot.general import get_config, write_to_config
+from musicbot.silence import get_file_stamp, get_song_offsets, load_silence_offsets
+from musicbot.startup import startup_timer
+
+if TYPE_CHECKING:
+    from mutagen.mp3 import MP3
 
 logger = loggers.createLogger('main.library')
 
+# Set by the launcher so every shard cluster reads the same prebuilt index instead of scanning the music folder.
+LIBRARY_INDEX_ENV = 'PHANBEATS_LIBRARY_INDEX'
+
+song_lengths_path = Path('temp') / 'song_lengths.json'
+
+
+class SongRecord:
+    """A read-only view of one row of a SongTable. Formatted values are derived on access instead of stored."""
+
+    __slots__ = ('table', 'row')
+
+    def __init__(self, table: 'SongTable', row: int) -> None:
+        self.table = table
+        self.row = row
+
+    @property
+    def song_id(self) -> int:
+        return self.table.ids[self.row]
+
+    @property
+    def title(self) -> str:
+        return self.table.titles[self.row]
+
+    @property
+    def folder(self) -> str:
+        return self.table.folders[self.table.folder_ids[self.row]]
+
+    @property
+    def artist(self) -> str:
+        return self.table.artists[self.table.folder_artist_ids[self.table.folder_ids[self.row]]]
+
+    @property
+    def filepath(self) -> str:
+        return os.path.join(self.folder, f"{self.raw_name}.mp3")
+
+    @property
+    def raw_name(self) -> str:
+        return f"[{self.song_id}] {self.title}"
+
+    @property
+    def duration_seconds(self) -> int:
+        return self.table.lengths[self.row]
+
+    @property
+    def duration(self) -> tuple[int, int, int]:
+        return split_duration(self.duration_seconds)
+
+    @property
+    def duration_str(self) -> str:
+        return get_duration_string(self.duration)
+
+    @property
+    def trim_start(self) -> float:
+        return self.table.trim_starts[self.row]
+
+    @property
+    def trim_end(self) -> Optional[float]:
+        return self.table.trim_ends[self.row] or None
+
+    @property
+    def end_position(self) -> float:
+        """Returns where playback of the song ends, in seconds from the start of the file. Unlike the duration, \
+        it isn't rounded to whole seconds."""
+        return self.trim_end or self.table.file_lengths[self.row] or self.trim_start + self.duration_seconds
+
+    @property
+    def artwork_hash(self) -> Optional[str]:
+        artwork_id = self.table.artwork_ids[self.row]
+        return self.table.artwork_hashes[artwork_id] if artwork_id >= 0 else None
+
+    @property
+    def artwork_path(self) -> Optional[Path]:
+        """Returns the path of the song's artwork thumbnail, if it has any."""
+        artwork_hash = self.artwork_hash
+        return get_thumbnail_path(artwork_hash) if artwork_hash else None
+
+
+class SongTable:
+    """A columnar store of the music library. Each song is a row across a few packed arrays: artist and folder \
+    strings are interned, durations are packed seconds next to the exact file lengths, and filepaths are derived \
+    from the song's folder and name. Rows are found by song ID in constant time through a dense ID-to-row array."""
+
+    def __init__(self) -> None:
+        self.ids = array('I')
+        self.titles: list[str] = []
+        self.folder_ids = array('I')
+        self.lengths = array('I')
+        self.trim_starts = array('f')
+        self.trim_ends = array('f')
+        self.file_lengths = array('f')
+        self.artwork_ids = array('i')
+
+        self.artwork_hashes: list[str] = []
+        self.folders: list[str] = []
+        self.folder_artist_ids = array('I')
+        self.artists: list[str] = []
+
+        # Every added song bumps the version and records it on its row, so exports can find what changed.
+        self.version = 0
+        self.row_versions = array('I')
+        self.deleted_versions: dict[int, int] = {}
+
+        self.rows_by_id = array('i')
+        self._folder_lookup: dict[str, int] = {}
+        self._artist_lookup: dict[str, int] = {}
+        self._artwork_lookup: dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, song_id) -> bool:
+        return self.get_row(song_id) is not None
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __getitem__(self, song_id: int) -> SongRecord:
+        row = self.get_row(song_id)
+        if row is None:
+            raise KeyError(song_id)
+
+        return SongRecord(self, row)
+
+    def get_row(self, song_id) -> Optional[int]:
+        if not isinstance(song_id, int) or not 0 <= song_id < len(self.rows_by_id):
+            return None
+
+        row = self.rows_by_id[song_id]
+        return row if row >= 0 else None
+
+    def items(self):
+        for row, song_id in enumerate(self.ids):
+            yield song_id, SongRecord(self, row)
+
+    def intern_folder(self, folder: str, artist: str) -> int:
+        """Returns the index of a folder, adding it and its artist the first time they're seen."""
+        folder_id = self._folder_lookup.get(folder)
+        if folder_id is None:
+            artist_id = self._artist_lookup.get(artist)
+            if artist_id is None:
+                artist_id = self._artist_lookup[artist] = len(self.artists)
+                self.artists.append(artist)
+
+            folder_id = self._folder_lookup[folder] = len(self.folders)
+            self.folders.append(folder)
+            self.folder_artist_ids.append(artist_id)
+
+        return folder_id
+
+    def add(self, song_id: int, title: str, folder: str, artist: str, length: int, trim_start: float = 0.0,
+            trim_end: float = 0.0, file_length: float = 0.0) -> None:
+        """Appends a song to the table."""
+        if song_id in self:
+            raise ValueError(f"Song {song_id} is already in the library.")
+
+        if song_id >= len(self.rows_by_id):
+            self.rows_by_id.extend([-1] * (song_id + 1 - len(self.rows_by_id)))
+        self.rows_by_id[song_id] = len(self.ids)
+
+        self.ids.append(song_id)
+        self.titles.append(title)
+        self.folder_ids.append(self.intern_folder(folder, artist))
+        self.lengths.append(length)
+        self.trim_starts.append(trim_start)
+        self.trim_ends.append(trim_end)
+        self.file_lengths.append(file_length)
+        self.artwork_ids.append(-1)
+
+        self.version += 1
+        self.row_versions.append(self.version)
+
+    def set_artwork(self, song_id: int, artwork_hash: str) -> None:
+        """Attaches artwork to a song. Songs with the same artwork share one interned hash."""
+        artwork_id = self._artwork_lookup.get(artwork_hash)
+        if artwork_id is None:
+            artwork_id = self._artwork_lookup[artwork_hash] = len(self.artwork_hashes)
+            self.artwork_hashes.append(artwork_hash)
+
+        self.artwork_ids[self.get_row(song_id)] = artwork_id
+
+    def to_dict(self) -> dict:
+        return {
+            'ids': self.ids.tolist(),
+            'titles': self.titles,
+            'folder_ids': self.folder_ids.tolist(),
+            'lengths': self.lengths.tolist(),
+            'trim_starts': self.trim_starts.tolist(),
+            'trim_ends': self.trim_ends.tolist(),
+            'file_lengths': self.file_lengths.tolist(),
+            'artwork_ids': self.artwork_ids.tolist(),
+            'artwork_hashes': self.artwork_hashes,
+            'folders': self.folders,
+            'folder_artist_ids': self.folder_artist_ids.tolist(),
+            'artists': self.artists,
+            'version': self.version,
+            'row_versions': self.row_versions.tolist(),
+            'deleted_versions': self.deleted_versions,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'SongTable':
+        table = cls()
+        for row, song_id in enumerate(data['ids']):
+            folder_id = data['folder_ids'][row]
+            artist = data['artists'][data['folder_artist_ids'][folder_id]]
+            table.add(song_id, data['titles'][row], data['folders'][folder_id], artist, data['lengths'][row],
+                      data['trim_starts'][row], data['trim_ends'][row], data['file_lengths'][row])
+
+            artwork_id = data['artwork_ids'][row]
+            if artwork_id >= 0:
+                table.set_artwork(song_id, data['artwork_hashes'][artwork_id])
+
+        table.version = data['version']
+        table.row_versions = array('I', data['row_versions'])
+        table.deleted_versions = {int(song_id): version for song_id, version in data['deleted_versions'].items()}
+
+        return table
+
 
 class Library:
     def __init__(self):
-        self.library = get_library()
-        self.song_raw_names = self.get_all_song_raw_names()
-        self.song_raw_names_with_artist = self.get_all_song_raw_names_with_artist()
-        # self.generate_data_for_sheets()
+        index_path = os.environ.get(LIBRARY_INDEX_ENV)
+        with startup_timer.phase('library'):
+            self.library = load_library_index(index_path) if index_path else get_library()
+        self.autocomplete_rows = array('I', range(len(self.library)))
 
     def get_all_song_ids(self) -> list[int]:
         """Gets a list of all the song ids in the music library."""
-        song_ids = []
-        for song_id, _ in self.library.items():
-            song_ids.append(song_id)
-
-        song_ids.sort()
-
-        return song_ids
+        return sorted(self.library.ids)
 
     def get_all_song_raw_names(self) -> list[str]:
         """Gets a list of all the song filenames of the music library."""
+        return sorted(record.raw_name for _, record in self.library.items())
 
-        song_raw_names = []
-        for song_id, song_metadata in self.library.items():
-            title = song_metadata['title']
-            filename = f"[{song_id}] {title}"
-            song_raw_names.append(filename)
-        song_raw_names.sort()
+    def set_popularity(self, play_counts: dict[int, int]) -> None:
+        """Ranks autocomplete choices by how often each song has been played, most played first."""
+        ids = self.library.ids
+        self.autocomplete_rows = array('I', sorted(range(len(ids)), key=lambda row: -play_counts.get(ids[row], 0)))
 
-        return song_raw_names
+    async def song_raw_names_autocomplete(self, interaction: discord.Interaction, current: str) -> list[
+        app_commands.Choice]:
+        """Converts the list of song names to a list of Choices."""
 
-    def get_all_song_raw_names_with_artist(self) -> list[tuple]:
-        """Gets a list of all the song filenames of the music library with their respective artist."""
+        current = current.lower()
+        choice_list = []
+        for row in self.autocomplete_rows:
+            record = SongRecord(self.library, row)
+            # raw_name is song title w/ id. (ex. [1] Bring Me To Life)
+            raw_name = record.raw_name
+            artist = record.artist
+            if current in raw_name.lower() or current in artist.lower():
+                choice_list.append(app_commands.Choice(name=f"{raw_name} by {artist}", value=raw_name))
+                if len(choice_list) == 25:
+                    break
 
-        song_raw_names = []
-        for song_id, song_metadata in self.library.items():
-            title = song_metadata['title']
-            artist = song_metadata['artist']
-            filename = f"[{song_id}] {title}"
-            song_raw_names.append((filename, artist))
+        return choice_list
 
-        return song_raw_names
 
-    async def song_raw_names_autocomplete(self, interaction: discord.Interaction, current: str) -> list[
-        app_commands.Choice]:
-        """Converts the list of song names to a list of Choices."""
+def load_song_lengths() -> dict[int, dict]:
+    """Returns the stored file lengths as {song_id: {'length', 'stamp'}}."""
+    try:
+        with open(song_lengths_path, 'r') as f:
+            return {int(song_id): entry for song_id, entry in json.load(f).items()}
+    except FileNotFoundError:
+        return {}
+
+
+def get_file_length(song_lengths: dict[int, dict], song_id: int, filepath: str) -> float:
+    """Returns the exact length of a song's file in seconds. The file is only read with mutagen if it is new or \
+    has changed since the last scan, and the stored lengths are updated when it is."""
+    stamp = get_file_stamp(filepath)
+    entry = song_lengths.get(song_id)
+    if entry and entry['stamp'] == stamp:
+        return entry['length']
+
+    # Only needed for new or changed files, so most startups never import mutagen.
+    from mutagen.mp3 import MP3
 
-        choices = self.song_raw_names_with_artist
-
-        # choice[0] is song title w/ id. (ex. [1] Bring Me To Life)
-        # choice[1] is artist name (ex. Evanescence)
-        choice_list = [app_commands.Choice(name=f"{choice[0]} by {choice[1]}", value=f"{choice[0]}") for choice in
-                       choices if
-                       current.lower() in choice[0].lower() or current.lower() in choice[1].lower()]
-
-        return choice_list[:25]
-
-    # def generate_data_for_sheets(self):
-    #     song_ids = []
-    #     song_names = []
-    #     artists = []
-    #
-    #     for song_id, song_data in list(self.library.items()):
-    #         song_ids.append(str(song_id))
-    #         song_names.append(song_data['title'])
-    #         artists.append(song_data['artist'])
-    #
-    #     song_id_string = '|'.join(song_ids)
-    #     song_names_string = '|'.join(song_names)
-    #     artists_string = '|'.join(artists)
-    #
-    #     full_text = f"{song_id_string}\n\n{song_names_string}\n\n{artists_string}"
-    #
-    #     logger.debug('Writing to file')
-    #     with open('test.txt', 'w') as f:
-    #         f.write(full_text)
-    #     logger.debug(("Wrote to file"))
-
-
-def get_song_metadata(filepath: str) -> dict:
-    """Parses a song's filepath and returns a tuple containing the song's ID and metadata."""
+    length = MP3(filepath).info.length
+    song_lengths[song_id] = {'length': length, 'stamp': stamp}
+
+    return length
+
+
+def get_song_metadata(filepath: str, song_lengths: dict[int, dict]) -> dict:
+    """Parses a song's filepath and returns a dictionary containing the song's ID and metadata."""
 
     song_id_regex = re.compile(r"((.*)\\(.*)\\)\[(\d*)] (.*).mp3")
     match = re.search(song_id_regex, filepath)
@@ -100,39 +316,38 @@ def get_song_metadata(filepath: str) -> dict:
     artist = match.group(3)
     song_id = int(match.group(4))
     title = match.group(5)
-    raw_name = f"[{song_id}] {title}"
 
-    mutagen_source = MP3(str(filepath))
-    duration = parse_duration(mutagen_source)
-    duration_str = get_duration_string(duration)
+    file_length = get_file_length(song_lengths, song_id, filepath)
+    length = math.trunc(file_length)
 
     metadata = {
+        'song_id': song_id,
         'artist': artist,
         'title': title,
-        'duration': duration,
-        'duration_str': duration_str,
-        'filepath': filepath,
-        'raw_name': raw_name,
+        'folder': os.path.dirname(filepath),
+        'length': length,
+        'trim_start': 0.0,
+        'trim_end': 0.0,
+        'file_length': file_length,
     }
 
     return metadata
 
 
-def get_song_album_art(filepath: str) -> Optional[str]:
-    """Reads the album art text file in specified file."""
-    try:
-        with open(filepath, 'r') as f:
-            url = f.read()
-    except FileNotFoundError:
-        return None
-
-    return url
+def apply_silence_offsets(metadata: dict, start: float, end: float) -> None:
+    """Trims a song's leading and trailing silence from its metadata and duration."""
+    metadata['trim_start'] = start
+    metadata['trim_end'] = end
+    metadata['length'] = math.trunc(end - start)
 
 
-def parse_duration(mp3_file: MP3) -> tuple[int, int, int]:
+def parse_duration(mp3_file: 'MP3') -> tuple[int, int, int]:
     """Returns a song's duration in a tuple (hours, minutes, seconds)."""
-    length_in_seconds = math.trunc(mp3_file.info.length)
+    return split_duration(math.trunc(mp3_file.info.length))
 
+
+def split_duration(length_in_seconds: int) -> tuple[int, int, int]:
+    """Splits a number of seconds into a tuple (hours, minutes, seconds)."""
     hours, seconds = divmod(length_in_seconds, 3600)
     minutes, seconds = divmod(seconds, 60)
 
@@ -161,18 +376,25 @@ def get_song_id(filename: str) -> Optional[int]:
     return int(match.group(1)) if match else None
 
 
-def get_library() -> dict:
-    """Returns a dictionary of all available songs in a given directory. \
-    The dictionary will be formatted as follows: {song_id: {song_metadata}}"""
+def get_library_roots(config: dict) -> list[Path]:
+    """Returns the folders the music library is spread across, in the order they're scanned."""
+    return [Path(root) for root in config['library']['roots']]
+
 
-    musicFolder = Path('music')
+def get_library() -> SongTable:
+    """Returns a table of all available songs across the library roots, looked up by song ID. \
+    Song IDs are shared by every root, so new songs are numbered after the last ID used in any of them."""
 
-    library = {}
+    library = SongTable()
     config = get_config()
     last_song_id_used = config['library']['last_song_id_used']
     config_needs_updating = False
+    silence_offsets = load_silence_offsets()
+    song_lengths = load_song_lengths()
+    stored_lengths = dict(song_lengths)
 
-    for root, dirs, files in os.walk(musicFolder, topdown=True):
+    walks = (os.walk(musicFolder, topdown=True) for musicFolder in get_library_roots(config))
+    for root, dirs, files in itertools.chain.from_iterable(walks):
         for name in files:
             if name.endswith('.mp3'):
                 song_path = str(os.path.join(root, name))
@@ -186,16 +408,51 @@ def get_library() -> dict:
                     os.rename(song_path, new_filepath)
 
                     song_path = new_filepath
+                    song_id = new_song_id
                     last_song_id_used = new_song_id
                     config['library']['last_song_id_used'] = last_song_id_used
                     config_needs_updating = True
 
-                song_metadata = get_song_metadata(song_path)
-                library[song_id] = song_metadata
+                if song_id in library:
+                    logger.error(f"Skipped {song_path} because song {song_id} is already at "
+                                 f"{library[song_id].filepath}")
+                    continue
+
+                song_metadata = get_song_metadata(song_path, song_lengths)
+                song_offsets = get_song_offsets(silence_offsets, song_id, song_path)
+                if song_offsets:
+                    apply_silence_offsets(song_metadata, *song_offsets)
+                library.add(song_id, song_metadata['title'], song_metadata['folder'], song_metadata['artist'],
+                            song_metadata['length'], song_metadata['trim_start'], song_metadata['trim_end'],
+                            song_metadata['file_length'])
+                ensure_frame_index(song_id, song_path)
 
     if config_needs_updating:
         write_to_config(config)
 
+    song_lengths = {song_id: entry for song_id, entry in song_lengths.items() if song_id in library}
+    if song_lengths != stored_lengths:
+        write_json(song_lengths_path, song_lengths)
+
+    update_artwork(library)
+    track_versions(library)
+
+    return library
+
+
+def save_library_index(library: SongTable, filepath: str) -> None:
+    """Writes a scanned library to an index file that other processes can load without rescanning."""
+    with open(filepath, 'w') as f:
+        json.dump(library.to_dict(), f)
+
+
+def load_library_index(filepath: str) -> SongTable:
+    """Reads a library index written by save_library_index. The music folder is left untouched."""
+    with open(filepath, 'r') as f:
+        library = SongTable.from_dict(json.load(f))
+
+    logger.debug(f"Loaded {len(library)} songs from the library index at {filepath}")
+
     return library
 
 
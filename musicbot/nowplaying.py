@@ -0,0 +1,83 @@
+import asyncio
+import time
+from pathlib import Path
+from typing import Optional
+
+import discord
+
+from logs import loggers
+from musicbot.general import initial_config
+
+logger = loggers.createLogger('main.nowplaying')
+
+
+class NowPlayingMessage:
+    """Keeps a single now-playing message per guild up to date with as few API calls as possible. \
+    Only the latest embed is sent once transitions settle, calls are spaced out, an embed that is already shown \
+    (ex. a looping song) is never resent, and the message is edited while it is still the last one in the channel."""
+
+    def __init__(self, channel: discord.abc.Messageable) -> None:
+        config = initial_config['now_playing']
+        self.channel = channel
+        self.debounce = config['debounce']
+        self.min_interval = config['min_interval']
+
+        self.message: Optional[discord.Message] = None
+        self.shown_embed: Optional[discord.Embed] = None
+        self.pending_embed: Optional[discord.Embed] = None
+        self.pending_artwork: Optional[Path] = None
+        self.last_call = 0.0
+        self._flusher: Optional[asyncio.Task] = None
+
+        self.updates = 0
+        self.api_calls = 0
+
+    def update(self, embed: discord.Embed, artwork_path: Optional[Path] = None) -> None:
+        """Queues an embed, and the artwork thumbnail it shows, to be shown. Only the most recent one is ever sent."""
+        self.updates += 1
+        self.pending_embed = embed
+        self.pending_artwork = artwork_path
+
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.get_running_loop().create_task(self._flush())
+
+    async def _flush(self) -> None:
+        await asyncio.sleep(self.debounce)
+
+        while self.pending_embed is not None:
+            wait = self.last_call + self.min_interval - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+            embed, self.pending_embed = self.pending_embed, None
+            if embed is self.shown_embed:
+                continue
+
+            try:
+                await self._show(embed, self.pending_artwork)
+            except discord.HTTPException:
+                logger.error(f"Failed to show the now-playing message.", exc_info=True)
+            self.last_call = time.monotonic()
+
+    def _is_last_message(self) -> bool:
+        return self.message is not None and self.channel.last_message_id == self.message.id
+
+    async def _show(self, embed: discord.Embed, artwork_path: Optional[Path]) -> None:
+        self.api_calls += 1
+        files = [discord.File(artwork_path, filename=artwork_path.name)] if artwork_path else []
+        if self._is_last_message():
+            try:
+                await self.message.edit(embed=embed, attachments=files)
+                self.shown_embed = embed
+                return
+            except discord.NotFound:
+                self.message = None
+
+        self.message = await self.channel.send(embed=embed, files=files)
+        self.shown_embed = embed
+
+    def close(self) -> None:
+        """Drops any pending update."""
+        self.pending_embed = None
+        if self._flusher:
+            self._flusher.cancel()
@@ -0,0 +1,111 @@
+import bisect
+from array import array
+from typing import Optional
+
+import discord
+from discord import app_commands
+
+from logs import loggers
+from musicbot.library import SongTable, main_library
+
+logger = loggers.createLogger('main.query')
+
+
+class LibraryQuery:
+    """Secondary indexes over the song table: songs by artist, songs sorted by length, and sorted song IDs. \
+    Queries start from whichever index matches the fewest songs, so their cost follows the size of the result. \
+    The indexes are built from the library as scanned at startup, so new songs join them on the next scan."""
+
+    def __init__(self, library: SongTable) -> None:
+        self.library = library
+
+        self.ids_by_artist: dict[str, array] = {}
+        self.artist_names: dict[str, str] = {}
+        self.sorted_ids = array('I', sorted(library.ids))
+
+        rows_by_length = sorted(range(len(library)), key=lambda row: library.lengths[row])
+        self.sorted_lengths = array('I', (library.lengths[row] for row in rows_by_length))
+        self.ids_by_length = array('I', (library.ids[row] for row in rows_by_length))
+
+        for song_id in self.sorted_ids:
+            self._index_artist(song_id)
+
+    def _index_artist(self, song_id: int) -> None:
+        artist = self.library[song_id].artist
+        key = artist.lower()
+        self.artist_names.setdefault(key, artist)
+        song_ids = self.ids_by_artist.setdefault(key, array('I'))
+        song_ids.insert(bisect.bisect(song_ids, song_id), song_id)
+
+    def ids_by_artist_name(self, artist: str) -> array:
+        return self.ids_by_artist.get(artist.lower(), array('I'))
+
+    def length_bounds(self, min_length: Optional[int], max_length: Optional[int]) -> tuple[int, int]:
+        start = bisect.bisect_left(self.sorted_lengths, min_length) if min_length is not None else 0
+        end = bisect.bisect_right(self.sorted_lengths, max_length) if max_length is not None else \
+            len(self.sorted_lengths)
+
+        return start, end
+
+    def id_bounds(self, first_id: Optional[int], last_id: Optional[int]) -> tuple[int, int]:
+        start = bisect.bisect_left(self.sorted_ids, first_id) if first_id is not None else 0
+        end = bisect.bisect_right(self.sorted_ids, last_id) if last_id is not None else len(self.sorted_ids)
+
+        return start, end
+
+    def ids_in_length_range(self, min_length: Optional[int], max_length: Optional[int]) -> array:
+        """Returns the IDs of songs whose length in seconds is within an inclusive range."""
+        start, end = self.length_bounds(min_length, max_length)
+        return self.ids_by_length[start:end]
+
+    def ids_in_id_range(self, first_id: Optional[int], last_id: Optional[int]) -> array:
+        """Returns the song IDs within an inclusive range."""
+        start, end = self.id_bounds(first_id, last_id)
+        return self.sorted_ids[start:end]
+
+    def select(self, artist: Optional[str] = None, min_length: Optional[int] = None, max_length: Optional[int] = None,
+               first_id: Optional[int] = None, last_id: Optional[int] = None, limit: Optional[int] = None) -> list[int]:
+        """Returns the sorted IDs of the songs matching every given filter."""
+        # Each candidate is (size, index, start, end). Only the smallest one is walked.
+        start, end = self.id_bounds(first_id, last_id)
+        candidates = [(end - start, self.sorted_ids, start, end)]
+        if artist is not None:
+            artist_ids = self.ids_by_artist_name(artist)
+            candidates.append((len(artist_ids), artist_ids, 0, len(artist_ids)))
+        if min_length is not None or max_length is not None:
+            start, end = self.length_bounds(min_length, max_length)
+            candidates.append((end - start, self.ids_by_length, start, end))
+
+        _, index, start, end = min(candidates, key=lambda candidate: candidate[0])
+        smallest = index[start:end]
+        artist_key = artist.lower() if artist is not None else None
+
+        song_ids = []
+        for song_id in smallest:
+            record = self.library[song_id]
+            if artist_key is not None and record.artist.lower() != artist_key:
+                continue
+            if min_length is not None and record.duration_seconds < min_length:
+                continue
+            if max_length is not None and record.duration_seconds > max_length:
+                continue
+            if (first_id is not None and song_id < first_id) or (last_id is not None and song_id > last_id):
+                continue
+
+            song_ids.append(song_id)
+
+        song_ids.sort()
+
+        return song_ids[:limit] if limit is not None else song_ids
+
+    async def artist_autocomplete(self, interaction: discord.Interaction, current: str) -> list[
+        app_commands.Choice]:
+        """Converts the list of artists to a list of Choices."""
+        current = current.lower()
+        choice_list = [app_commands.Choice(name=artist, value=artist) for key, artist in self.artist_names.items()
+                       if current in key]
+
+        return choice_list[:25]
+
+
+main_query = LibraryQuery(main_library.library)
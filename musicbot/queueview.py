@@ -0,0 +1,125 @@
+import math
+from typing import TYPE_CHECKING
+
+import discord
+
+from logs import loggers
+from musicbot.general import bot_name, bot_pfp_url
+
+if TYPE_CHECKING:
+    from musicbot.audioplayer import SongQueue
+
+logger = loggers.createLogger('main.queueview')
+
+
+class QueuePages:
+    """The rendered pages of a voice state's queue. Pages are rendered when first viewed and kept until the queue \
+    changes at or before them, so paging back and forth through a large queue only renders each page once."""
+
+    def __init__(self, songs: 'SongQueue', page_size: int = 10) -> None:
+        self.songs = songs
+        self.page_size = page_size
+        self.pages: dict[int, tuple[str, str]] = {}
+
+        self.hits = 0
+        self.renders = 0
+
+        songs.listeners.append(self.invalidate)
+
+    @property
+    def page_count(self) -> int:
+        return math.ceil(len(self.songs) / self.page_size)
+
+    def invalidate(self, index: int) -> None:
+        """Drops the pages from the one holding a changed queue position onwards."""
+        first_page = index // self.page_size
+        for page in [page for page in self.pages if page >= first_page]:
+            del self.pages[page]
+
+    def get_page(self, page: int) -> tuple[str, str]:
+        """Returns the song and artist columns of a page, counting pages from 0."""
+        rendered = self.pages.get(page)
+        if rendered is not None:
+            self.hits += 1
+            return rendered
+
+        start = page * self.page_size
+        songs = self.songs[start:start + self.page_size]
+        song_names = ''.join(f"`{i}.`  {song.title}\n" for i, song in enumerate(songs, start=start + 1))
+        artist_names = ''.join(f"`{song.artist}`\n" for song in songs)
+
+        self.renders += 1
+        rendered = self.pages[page] = (song_names, artist_names)
+        return rendered
+
+    def create_embed(self, page: int) -> discord.Embed:
+        """Creates the embed of a page, counting pages from 0."""
+        page_count = self.page_count
+        if page_count == 0:
+            embed = discord.Embed(title='Oops!', description='Looks like the queue is empty.', color=0xFFFFFF)
+            embed.set_author(name=bot_name, icon_url=bot_pfp_url)
+            return embed
+
+        song_names, artist_names = self.get_page(page)
+
+        embed = discord.Embed(title=f"Songs in Queue", color=0xFFFFFF)
+        embed.set_author(name=bot_name, icon_url=bot_pfp_url)
+
+        embed.add_field(name='Song', value=song_names)
+        embed.add_field(name='Artist', value=artist_names)
+        embed.set_footer(text=f"Viewing page {page + 1}/{page_count}")
+
+        return embed
+
+
+class QueuePaginator(discord.ui.View):
+    """Buttons that page through the queue by editing the same message. The timeout has to stay under the 15 \
+    minutes an interaction can be edited for, so the buttons can be removed through it when they expire."""
+
+    def __init__(self, queue_pages: QueuePages, interaction: discord.Interaction, page: int = 0,
+                 timeout: float = 180) -> None:
+        super().__init__(timeout=timeout)
+        self.queue_pages = queue_pages
+        self.interaction = interaction
+        self.page = page
+        self.update_buttons()
+
+    def clamp_page(self) -> None:
+        self.page = max(0, min(self.page, self.queue_pages.page_count - 1))
+
+    def update_buttons(self) -> None:
+        self.clamp_page()
+        last_page = self.queue_pages.page_count - 1
+        self._first.disabled = self._previous.disabled = self.page <= 0
+        self._next.disabled = self._last.disabled = self.page >= last_page
+
+    def create_embed(self) -> discord.Embed:
+        return self.queue_pages.create_embed(self.page)
+
+    async def show_page(self, interaction: discord.Interaction, page: int) -> None:
+        self.page = page
+        self.update_buttons()
+        await interaction.response.edit_message(embed=self.create_embed(), view=self)
+
+    @discord.ui.button(label='<<', style=discord.ButtonStyle.secondary)
+    async def _first(self, interaction: discord.Interaction, button: discord.ui.Button) -> None:
+        await self.show_page(interaction, 0)
+
+    @discord.ui.button(label='<', style=discord.ButtonStyle.secondary)
+    async def _previous(self, interaction: discord.Interaction, button: discord.ui.Button) -> None:
+        await self.show_page(interaction, self.page - 1)
+
+    @discord.ui.button(label='>', style=discord.ButtonStyle.secondary)
+    async def _next(self, interaction: discord.Interaction, button: discord.ui.Button) -> None:
+        await self.show_page(interaction, self.page + 1)
+
+    @discord.ui.button(label='>>', style=discord.ButtonStyle.secondary)
+    async def _last(self, interaction: discord.Interaction, button: discord.ui.Button) -> None:
+        await self.show_page(interaction, self.queue_pages.page_count - 1)
+
+    async def on_timeout(self) -> None:
+        """Removes the buttons once they stop working."""
+        try:
+            await self.interaction.edit_original_response(view=None)
+        except discord.HTTPException:
+            logger.debug(f"Failed to remove the queue buttons.", exc_info=True)
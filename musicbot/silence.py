@@ -0,0 +1,117 @@
+import json
+import os
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import TYPE_CHECKING, Optional
+
+import numpy as np
+
+from logs import loggers
+from musicbot.general import initial_config
+from musicbot.governor import Priority, run_ffmpeg
+
+if TYPE_CHECKING:
+    from musicbot.library import SongTable
+
+logger = loggers.createLogger('main.silence')
+
+offsets_path = Path('temp') / 'silence_offsets.json'
+analysis_sample_rate = 8000
+
+
+def detect_silence(samples: np.ndarray, sample_rate: int, threshold_db: float, window_ms: int) -> tuple[float, float]:
+    """Returns the (start, end) in seconds of the audible part of mono PCM samples."""
+    window = max(1, sample_rate * window_ms // 1000)
+    window_count = len(samples) // window
+    total = len(samples) / sample_rate
+    if window_count == 0:
+        return 0.0, total
+
+    frames = samples[:window_count * window].astype(np.float32).reshape(window_count, window) / 32768.0
+    rms = np.sqrt(np.mean(np.square(frames), axis=1))
+    loud = np.flatnonzero(rms > 10 ** (threshold_db / 20))
+    if loud.size == 0:
+        return 0.0, total
+
+    start = float(loud[0] * window / sample_rate)
+    end = float(min((loud[-1] + 1) * window / sample_rate, total))
+
+    return start, end
+
+
+def decode_song(filepath: str) -> np.ndarray:
+    """Decodes a song into mono 16-bit PCM at the analysis sample rate."""
+    output = run_ffmpeg(
+        ['ffmpeg', '-v', 'error', '-i', filepath, '-f', 's16le', '-ac', '1', '-ar', str(analysis_sample_rate),
+         'pipe:1'],
+        Priority.INGEST
+    )
+
+    return np.frombuffer(output, dtype=np.int16)
+
+
+def analyse_song(filepath: str) -> tuple[float, float]:
+    """Finds the leading and trailing silence of a song. Runs in a worker process."""
+    config = initial_config['silence']
+    samples = decode_song(filepath)
+
+    return detect_silence(samples, analysis_sample_rate, config['threshold_db'], config['window_ms'])
+
+
+def get_file_stamp(filepath: str) -> list[int]:
+    stat = os.stat(filepath)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def load_silence_offsets() -> dict[int, dict]:
+    """Returns the stored offsets as {song_id: {'start', 'end', 'stamp'}}."""
+    try:
+        with open(offsets_path, 'r') as f:
+            return {int(song_id): offsets for song_id, offsets in json.load(f).items()}
+    except FileNotFoundError:
+        return {}
+
+
+def save_silence_offsets(offsets: dict[int, dict]) -> None:
+    offsets_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(offsets_path, 'w') as f:
+        json.dump(offsets, f)
+
+
+def get_song_offsets(offsets: dict[int, dict], song_id: int, filepath: str) -> Optional[tuple[float, float]]:
+    """Returns the stored (start, end) of a song, or None if it has not been analysed since it last changed."""
+    song_offsets = offsets.get(song_id)
+    if not song_offsets or song_offsets['stamp'] != get_file_stamp(filepath):
+        return None
+
+    return song_offsets['start'], song_offsets['end']
+
+
+def analyse_library(library: 'SongTable', workers: Optional[int] = None) -> dict[int, dict]:
+    """Analyses every song that is new or has changed since the last run, in parallel, and stores the offsets."""
+    offsets = load_silence_offsets()
+    pending = {song_id: record.filepath for song_id, record in library.items()
+               if get_song_offsets(offsets, song_id, record.filepath) is None}
+    logger.info(f"Analysing silence in {len(pending)} of {len(library)} songs...")
+
+    with ProcessPoolExecutor(max_workers=workers or initial_config['governor']['ingest_workers']) as executor:
+        futures = {song_id: executor.submit(analyse_song, filepath) for song_id, filepath in pending.items()}
+        for song_id, future in futures.items():
+            try:
+                start, end = future.result()
+            except (subprocess.CalledProcessError, OSError):
+                logger.error(f"Failed to analyse song {song_id}", exc_info=True)
+                continue
+
+            offsets[song_id] = {'start': start, 'end': end, 'stamp': get_file_stamp(pending[song_id])}
+
+    save_silence_offsets(offsets)
+
+    return offsets
+
+
+if __name__ == '__main__':
+    from musicbot.library import main_library
+
+    analyse_library(main_library.library)
@@ -0,0 +1,205 @@
+import math
+import random
+import threading
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from subprocess import CalledProcessError
+from typing import TYPE_CHECKING, Iterable, Optional
+
+import numpy as np
+
+from logs import loggers
+from musicbot.general import initial_config
+from musicbot.silence import analysis_sample_rate, decode_song
+
+if TYPE_CHECKING:
+    from musicbot.library import SongTable
+
+logger = loggers.createLogger('main.similarity')
+
+features_path = Path('temp') / 'audio_features.npz'
+
+artist_dimensions = 16
+band_count = 8
+audio_dimensions = 4 + band_count
+window_size = 2048
+
+artist_weight = 1.0
+duration_weight = 0.5
+audio_weight = 1.0
+
+
+def compute_audio_features(samples: np.ndarray, sample_rate: int) -> np.ndarray:
+    """Summarises mono PCM as loudness, brightness and the energy in a few log-spaced frequency bands."""
+    features = np.zeros(audio_dimensions, dtype=np.float32)
+    window_count = len(samples) // window_size
+    if window_count == 0:
+        return features
+
+    windows = samples[:window_count * window_size].astype(np.float32).reshape(window_count, window_size) / 32768.0
+    rms = np.sqrt(np.mean(np.square(windows), axis=1))
+    zero_crossings = np.mean(np.abs(np.diff(np.signbit(windows), axis=1)), axis=1)
+
+    spectrum = np.abs(np.fft.rfft(windows * np.hanning(window_size), axis=1))
+    frequencies = np.fft.rfftfreq(window_size, 1 / sample_rate)
+    power = spectrum.sum(axis=1) + 1e-9
+    centroid = (spectrum @ frequencies) / power
+
+    edges = np.geomspace(40, sample_rate / 2, band_count + 1)
+    band_ids = np.clip(np.searchsorted(edges, frequencies) - 1, 0, band_count - 1)
+    band_energy = np.zeros((window_count, band_count), dtype=np.float32)
+    np.add.at(band_energy.T, band_ids, spectrum.T)
+    band_energy /= power[:, None]
+
+    features[0] = rms.mean()
+    features[1] = rms.std()
+    features[2] = centroid.mean() / (sample_rate / 2)
+    features[3] = zero_crossings.mean()
+    features[4:] = band_energy.mean(axis=0)
+
+    return features
+
+
+def analyse_song(filepath: str) -> np.ndarray:
+    """Computes the audio features of a song. Runs in a worker process."""
+    return compute_audio_features(decode_song(filepath), analysis_sample_rate)
+
+
+def get_metadata_features(artist: str, duration_seconds: float) -> np.ndarray:
+    """Hashes the artist into a few dimensions and adds the song length on a log scale."""
+    features = np.zeros(artist_dimensions + 1, dtype=np.float32)
+    features[zlib.crc32(artist.lower().encode()) % artist_dimensions] = artist_weight
+    features[-1] = duration_weight * math.log1p(max(duration_seconds, 0)) / math.log1p(3600)
+
+    return features
+
+
+def load_audio_features() -> dict[int, np.ndarray]:
+    try:
+        with np.load(features_path) as data:
+            return dict(zip(data['song_ids'].tolist(), data['features']))
+    except FileNotFoundError:
+        return {}
+
+
+def save_audio_features(audio_features: dict[int, np.ndarray]) -> None:
+    features_path.parent.mkdir(parents=True, exist_ok=True)
+    song_ids = np.fromiter(audio_features, dtype=np.int64, count=len(audio_features))
+    features = np.stack(list(audio_features.values())) if audio_features else np.zeros((0, audio_dimensions))
+    np.savez(features_path, song_ids=song_ids, features=features)
+
+
+def analyse_library(library: 'SongTable', workers: Optional[int] = None) -> dict[int, np.ndarray]:
+    """Computes audio features for every song that doesn't have them yet, in parallel, and stores them. \
+    The bot's similarity index uses them the next time it is built, ex. when the bot restarts."""
+    audio_features = load_audio_features()
+    pending = {song_id: record.filepath for song_id, record in library.items()
+               if song_id not in audio_features}
+    logger.info(f"Computing audio features for {len(pending)} of {len(library)} songs...")
+
+    with ProcessPoolExecutor(max_workers=workers or initial_config['governor']['ingest_workers']) as executor:
+        futures = {song_id: executor.submit(analyse_song, filepath) for song_id, filepath in pending.items()}
+        for song_id, future in futures.items():
+            try:
+                audio_features[song_id] = future.result()
+            except (CalledProcessError, OSError):
+                logger.error(f"Failed to analyse song {song_id}", exc_info=True)
+
+    save_audio_features(audio_features)
+
+    return audio_features
+
+
+class SimilarityIndex:
+    """Finds similar songs with a single matrix-vector product over L2-normalised feature rows. \
+    Rows live in a preallocated matrix that grows geometrically, so songs can be added one at a time. \
+    It's built from the library as scanned at startup, so songs added to the music folder join it on the next scan."""
+
+    def __init__(self, library: 'SongTable', audio_features: dict[int, np.ndarray]) -> None:
+        self.dimensions = artist_dimensions + 1 + audio_dimensions
+        self.matrix = np.zeros((max(len(library), 16), self.dimensions), dtype=np.float32)
+        self.song_ids = np.zeros(len(self.matrix), dtype=np.int64)
+        self.rows: dict[int, int] = {}
+        self.size = 0
+
+        # Audio features are standardised with the library-wide statistics, which new songs reuse.
+        known = np.stack(list(audio_features.values())) if audio_features else np.zeros((0, audio_dimensions))
+        self.audio_mean = known.mean(axis=0) if len(known) else np.zeros(audio_dimensions)
+        self.audio_std = known.std(axis=0) + 1e-6 if len(known) else np.ones(audio_dimensions)
+
+        for song_id, record in library.items():
+            self.add(song_id, record.artist, record.duration_seconds, audio_features.get(song_id))
+
+    def add(self, song_id: int, artist: str, duration_seconds: int,
+            audio_features: Optional[np.ndarray] = None) -> None:
+        """Adds or replaces a song's row."""
+        vector = np.zeros(self.dimensions, dtype=np.float32)
+        vector[:artist_dimensions + 1] = get_metadata_features(artist, duration_seconds)
+        if audio_features is not None:
+            standardised = (audio_features - self.audio_mean) / self.audio_std
+            vector[artist_dimensions + 1:] = audio_weight * standardised / math.sqrt(audio_dimensions)
+
+        norm = np.linalg.norm(vector)
+        if norm:
+            vector /= norm
+
+        row = self.rows.get(song_id)
+        if row is None:
+            if self.size == len(self.matrix):
+                self.matrix = np.concatenate([self.matrix, np.zeros_like(self.matrix)])
+                self.song_ids = np.concatenate([self.song_ids, np.zeros_like(self.song_ids)])
+            row = self.rows[song_id] = self.size
+            self.size += 1
+
+        self.matrix[row] = vector
+        self.song_ids[row] = song_id
+
+    def nearest(self, song_id: int, k: int = 10, exclude: Iterable[int] = ()) -> list[int]:
+        """Returns up to k song IDs most similar to a song, most similar first."""
+        row = self.rows.get(song_id)
+        if row is None:
+            return []
+
+        scores = self.matrix[:self.size] @ self.matrix[row]
+        scores[row] = -np.inf
+        excluded_rows = [self.rows[excluded_id] for excluded_id in exclude if excluded_id in self.rows]
+        scores[excluded_rows] = -np.inf
+
+        k = min(k, self.size)
+        candidates = np.argpartition(-scores, k - 1)[:k]
+        candidates = candidates[np.isfinite(scores[candidates])]
+        candidates = candidates[np.argsort(-scores[candidates])]
+
+        return self.song_ids[candidates].tolist()
+
+    def pick_next(self, song_id: int, recent_song_ids: Iterable[int], k: int = 5) -> Optional[int]:
+        """Picks one of the k songs most similar to a song, avoiding recently played songs."""
+        candidates = self.nearest(song_id, k, exclude=recent_song_ids)
+
+        return random.choice(candidates) if candidates else None
+
+
+_main_index: Optional[SimilarityIndex] = None
+_main_index_lock = threading.Lock()
+
+
+def get_similarity_index() -> SimilarityIndex:
+    """Returns the similarity index of the music library, building it on first use. \
+    It isn't built on import so the analysis worker processes never scan the library. Building it takes a while \
+    for a large library, so it should be called from a worker thread."""
+    global _main_index
+    if _main_index is None:
+        with _main_index_lock:
+            if _main_index is None:
+                from musicbot.library import main_library
+
+                _main_index = SimilarityIndex(main_library.library, load_audio_features())
+
+    return _main_index
+
+
+if __name__ == '__main__':
+    from musicbot.library import main_library
+
+    analyse_library(main_library.library)
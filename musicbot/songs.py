@@ -1,23 +1,30 @@
 import re
+from typing import Optional
 
 import discord
 
 from musicbot.general import bot_name, bot_pfp_url
 from musicbot.library import main_library
 
+# Now-playing embeds are built once per song and shared by every guild.
+embed_cache: dict[int, discord.Embed] = {}
+
 
 class Song:
     def __init__(self, song_id, yt_filepath=None):
         self.song_id = int(song_id) if song_id else None
 
         if self.song_id:
-            self.metadata = main_library.library[song_id]
-            self.filepath = self.metadata['filepath']
-            self.artist = self.metadata['artist']
-            self.title = self.metadata['title']
-            self.duration = self.metadata['duration']
-            self.duration_str = self.metadata['duration_str']
-            self.raw_name = self.metadata['raw_name']
+            self.metadata = main_library.library[self.song_id]
+            self.filepath = self.metadata.filepath
+            self.artist = self.metadata.artist
+            self.title = self.metadata.title
+            self.duration = self.metadata.duration
+            self.duration_str = self.metadata.duration_str
+            self.raw_name = self.metadata.raw_name
+            self.trim_start = self.metadata.trim_start
+            self.end_position = self.metadata.end_position
+            self.artwork_path = self.metadata.artwork_path
         # else:
         #     self.filepath = yt_filepath
         #     self.artist = "Unknown"
@@ -26,14 +33,30 @@ class Song:
         #     self.duration_str = ""
         #     self.raw_name = ""
 
-        self.embed = self.create_embed()
-
-        # TODO: figure out how to add album_art automatically
-
         # Set when song is called by the music player
         self.source = None
         self.requester = None
 
+        # Where playback starts the next time the song is played, e.g. when resuming or seeking.
+        self.start_position = 0.0
+
+    @property
+    def duration_seconds(self) -> int:
+        return self.metadata.duration_seconds
+
+    @property
+    def position(self) -> float:
+        """Returns how far into the song playback currently is, in seconds."""
+        return self.source.position if self.source else self.start_position
+
+    @property
+    def embed(self) -> discord.Embed:
+        embed = embed_cache.get(self.song_id)
+        if embed is None:
+            embed = embed_cache[self.song_id] = self.create_embed()
+
+        return embed
+
     def create_embed(self):
         """Creates and returns an embed detailing a song's information."""
         embed = discord.Embed(
@@ -45,6 +68,10 @@ class Song:
         embed.add_field(name='Duration', value=f"```{self.duration_str}```")
         embed.set_author(name=bot_name, icon_url=bot_pfp_url)
 
+        # The thumbnail is attached from the artwork cache when the embed is sent.
+        if self.artwork_path:
+            embed.set_thumbnail(url=f"attachment://{self.artwork_path.name}")
+
         return embed
 
 
@@ -55,3 +82,20 @@ def parse_id_from_raw_name(raw_name: str) -> int:
     song_id = int(match.group(1))
 
     return song_id
+
+
+def parse_timestamp(timestamp: str) -> Optional[float]:
+    """Parses a timestamp such as "90", "1:30" or "1:02:30" into seconds. Returns None if it is invalid."""
+    try:
+        parts = [float(part) for part in timestamp.strip().split(':')]
+    except ValueError:
+        return None
+
+    if not 1 <= len(parts) <= 3 or any(part < 0 for part in parts):
+        return None
+
+    seconds = 0.0
+    for part in parts:
+        seconds = seconds * 60 + part
+
+    return seconds
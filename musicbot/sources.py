@@ -1,26 +1,548 @@
+import asyncio
+import audioop
+import functools
+import threading
+import time
+from collections import Counter, OrderedDict
+from typing import Callable, Optional
+
 import discord
+import numpy as np
 
+from logs import loggers
+from musicbot.frameindex import get_frame_index
+from musicbot.general import initial_config
+from musicbot.governor import Priority, governor, tune_process
+from musicbot.hottier import hot_tier
 from musicbot.library import main_library
 from musicbot.songs import parse_id_from_raw_name
 
+logger = loggers.createLogger('main.sources')
+
+frame_seconds = discord.opus.Encoder.FRAME_LENGTH / 1000
+frame_samples = discord.opus.Encoder.SAMPLES_PER_FRAME * discord.opus.Encoder.CHANNELS
+frame_overhead = 41  # approximate size of a bytes object and its list slot, on top of its data
+
+# How far past its expected end a faded-out song is still read, so a song whose length is slightly off still finishes.
+drain_frames = int(1.0 / frame_seconds)
+
+
+read_ahead_frames = int(initial_config['read_ahead']['seconds'] / frame_seconds)
+
+# Totals over every read-ahead source that has finished playing.
+read_ahead_stats = Counter()
+read_ahead_lock = threading.Lock()
+
 
 class SourceError(Exception):
     pass
 
 
+class AudioCache:
+    """A memory-bounded LRU cache of Opus-encoded songs shared by every guild. \
+    A song is only admitted once it has been played a few times, so one-off plays don't evict the hot songs."""
+
+    def __init__(self, memory_budget: int, admit_after_plays: int) -> None:
+        self.memory_budget = memory_budget
+        self.admit_after_plays = admit_after_plays
+
+        self.entries: OrderedDict[int, list[bytes]] = OrderedDict()
+        self.entry_sizes: dict[int, int] = {}
+        self.play_counts = Counter()
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+
+    def get(self, song_id: int, count_play: bool = True) -> Optional[list[bytes]]:
+        """Returns a song's cached Opus frames. Only a song played from its start counts as a play, so seeking and \
+        looping don't get a one-off song admitted."""
+        with self._lock:
+            if count_play:
+                self.play_counts[song_id] += 1
+            frames = self.entries.get(song_id)
+            if frames is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(song_id)
+            self.hits += 1
+            return frames
+
+    def should_admit(self, song_id: int) -> bool:
+        with self._lock:
+            return song_id not in self.entries and self.play_counts[song_id] >= self.admit_after_plays
+
+    def put(self, song_id: int, frames: list[bytes]) -> None:
+        """Adds a song's Opus frames, evicting the least recently played songs to stay within the memory budget."""
+        entry_size = sum(len(frame) for frame in frames) + len(frames) * frame_overhead
+        if entry_size > self.memory_budget:
+            return
+
+        with self._lock:
+            if song_id in self.entries:
+                return
+
+            while self.size + entry_size > self.memory_budget:
+                evicted_id, _ = self.entries.popitem(last=False)
+                self.size -= self.entry_sizes.pop(evicted_id)
+                self.evictions += 1
+
+            self.entries[song_id] = frames
+            self.entry_sizes[song_id] = entry_size
+            self.size += entry_size
+
+        logger.debug(f"Cached song {song_id} ({entry_size / 1_000_000:.1f} MB). Cache is now {self.stats()}")
+
+    def seed_play_counts(self, play_counts: dict[int, int]) -> None:
+        """Carries play counts over from the play history so popular songs are admitted on their first play."""
+        with self._lock:
+            self.play_counts.update(play_counts)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'songs': len(self.entries),
+            'size': self.size,
+            'memory_budget': self.memory_budget,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+audio_cache = AudioCache(initial_config['audio_cache']['memory_budget_mb'] * 1_000_000,
+                         initial_config['audio_cache']['admit_after_plays'])
+
+
+class CachedOpusAudio(discord.AudioSource):
+    """Plays a song from the audio cache. Frames are decoded back to PCM so the volume can still be changed."""
+
+    def __init__(self, frames: list[bytes], first_frame: int = 0) -> None:
+        self.frames = frames
+        self.index = first_frame
+        self.decoder = discord.opus.Decoder()
+
+    def read(self) -> bytes:
+        if self.index >= len(self.frames):
+            return b''
+
+        frame = self.frames[self.index]
+        self.index += 1
+        return self.decoder.decode(frame, fec=False)
+
+
+class BufferedPCMAudio(discord.AudioSource):
+    """Reads an ffmpeg source ahead of playback on a background thread, so a slow disk or a busy CPU doesn't stall \
+    the player thread. Frames are read straight into a ring buffer of preallocated slots. A read that finds the \
+    buffer empty mid-song is an underrun, which is counted along with how long playback waited."""
+
+    def __init__(self, audio: discord.FFmpegPCMAudio, frame_count: int) -> None:
+        self.audio = audio
+        self._process = audio._process
+        self._stdout = audio._stdout
+
+        self.buffer = bytearray(frame_count * discord.opus.Encoder.FRAME_SIZE)
+        view = memoryview(self.buffer)
+        self.slots = [view[i * discord.opus.Encoder.FRAME_SIZE:(i + 1) * discord.opus.Encoder.FRAME_SIZE]
+                      for i in range(frame_count)]
+
+        # Both indexes only ever grow. The slot of a frame is its index modulo the number of slots.
+        self.read_index = 0
+        self.write_index = 0
+        self.finished_reading = False
+        self.closed = False
+
+        self.underruns = 0
+        self.stall_time = 0.0
+
+        self._condition = threading.Condition()
+        self._reader = threading.Thread(target=self._fill, daemon=True, name='read-ahead')
+        self._reader.start()
+
+    def _fill(self) -> None:
+        frame_count = len(self.slots)
+        while True:
+            with self._condition:
+                while self.write_index - self.read_index >= frame_count and not self.closed:
+                    self._condition.wait()
+                if self.closed:
+                    return
+                slot = self.slots[self.write_index % frame_count]
+
+            try:
+                size = self._stdout.readinto(slot)
+            except (OSError, ValueError):
+                size = 0
+
+            with self._condition:
+                if size != len(slot):
+                    self.finished_reading = True
+                else:
+                    self.write_index += 1
+                self._condition.notify_all()
+
+                if self.finished_reading:
+                    return
+
+    def read(self) -> bytes:
+        with self._condition:
+            if self.read_index == self.write_index and not self.finished_reading and not self.closed:
+                # Waiting for the very first frame is startup, not a stutter.
+                if self.read_index:
+                    self.underruns += 1
+                start = time.perf_counter()
+                self._condition.wait_for(lambda: self.read_index < self.write_index or self.finished_reading or
+                                         self.closed)
+                if self.read_index:
+                    self.stall_time += time.perf_counter() - start
+
+            if self.closed or self.read_index == self.write_index:
+                return b''
+
+            data = bytes(self.slots[self.read_index % len(self.slots)])
+            self.read_index += 1
+            self._condition.notify_all()
+
+            return data
+
+    def cleanup(self) -> None:
+        with self._condition:
+            if self.closed:
+                return
+            self.closed = True
+            self._condition.notify_all()
+
+        self.audio.cleanup()
+        with read_ahead_lock:
+            read_ahead_stats['sources'] += 1
+            read_ahead_stats['frames'] += self.read_index
+            read_ahead_stats['underruns'] += self.underruns
+            read_ahead_stats['stall_time'] += self.stall_time
+
+
 class SongSource(discord.PCMVolumeTransformer):
-    def __init__(self, source: discord.FFmpegPCMAudio, volume: float = 0.5):
+    def __init__(self, source: discord.AudioSource, volume: float = 0.5, start: float = 0.0):
         super().__init__(source, volume)
+        self.start = start
+        self.frames_read = 0
+
+        # Set while the source holds a governor slot for its ffmpeg process.
+        self.governor_priority = None
+        self._cleanup_lock = threading.Lock()
+
+        # Set while the song is being recorded into the audio cache.
+        self.song_id = None
+        self.encoder = None
+        self.recording = None
+        self.finished = False
+
+    def read(self) -> bytes:
+        data = self.original.read()
+        if not data:
+            self.finished = True
+            return b''
+
+        # The recording is taken before the volume is applied, so cached songs play at any volume.
+        if self.recording is not None:
+            self.recording.append(self.encoder.encode(data, discord.opus.Encoder.SAMPLES_PER_FRAME))
+
+        self.frames_read += 1
+        return audioop.mul(data, 2, min(self.volume, 2.0))
+
+    def drain(self, max_frames: int) -> bool:
+        """Reads the rest of the song without playing it, up to a number of frames. Returns whether it finished."""
+        for _ in range(max_frames):
+            if not self.read():
+                break
+
+        return self.finished
+
+    def start_recording(self, song_id: int) -> None:
+        """Records the Opus frames of the song as it plays, for the audio cache."""
+        self.song_id = song_id
+        self.encoder = discord.opus.Encoder()
+        self.recording = []
+
+    def cleanup(self) -> None:
+        super().cleanup()
+
+        # Cleanup can run from both the player thread and the event loop, so the slot and recording are taken once.
+        with self._cleanup_lock:
+            priority, self.governor_priority = self.governor_priority, None
+            recording, self.recording = self.recording, None
+
+        if priority is not None:
+            governor.release(priority)
+
+        # Only a song that played through to the end is complete enough to cache.
+        if recording and self.finished:
+            audio_cache.put(self.song_id, recording)
+
+    @property
+    def position(self) -> float:
+        """Returns the playback position within the song in seconds."""
+        return self.start + self.frames_read * frame_seconds
+
+    @property
+    def is_process_alive(self) -> bool:
+        """Returns whether the underlying ffmpeg process is still running."""
+        process = getattr(self.original, '_process', None)
+        return bool(process) and process.poll() is None
 
     @classmethod
-    async def create_source(cls, search: str):
-        """Creates a source of a song to be played."""
+    async def create_source(cls, search: str, start: float = 0.0, restart: bool = False):
+        """Creates a source of a song to be played, optionally starting at a position in seconds. \
+        Leading and trailing silence found by the silence analysis is skipped. A restart, ex. a seek or a loop, \
+        isn't counted as another play of the song."""
         song_id = parse_id_from_raw_name(search)
-        song_filepath = main_library.library[song_id]['filepath']
+        song_metadata = main_library.library[song_id]
+
+        count_play = not restart and start <= song_metadata.trim_start
+        start = max(start, song_metadata.trim_start)
+        if count_play:
+            hot_tier.record_play(song_id, song_metadata.filepath)
+
+        frames = audio_cache.get(song_id, count_play)
+        if frames is not None:
+            first_frame = int((start - song_metadata.trim_start) / frame_seconds)
+            return cls(CachedOpusAudio(frames, first_frame), start=start)
+
+        await governor.acquire_async(Priority.LIVE)
+        source = cls.create_ffmpeg_source(song_id, start, Priority.LIVE)
+        if start == song_metadata.trim_start and audio_cache.should_admit(song_id):
+            source.start_recording(song_id)
+
+        return source
+
+    @classmethod
+    def create_ffmpeg_source(cls, song_id: int, start: float, priority: Priority):
+        """Creates a source that decodes a song from disk with ffmpeg, starting at a position in seconds. \
+        The caller must already hold a governor slot of the given priority, which the source releases on cleanup."""
+        song_metadata = main_library.library[song_id]
+        song_filepath = song_metadata.filepath
+
+        # The frame index belongs to the original file, which a hot copy is identical to.
+        read_filepath = hot_tier.resolve(song_id, song_filepath)
+
+        before_options = None
+        options = "-vn"
+
+        if start > 0:
+            # Jump straight to the frame at the requested time, then decode only the remainder of that index entry.
+            frame_index = get_frame_index(song_id, str(song_filepath))
+            if frame_index:
+                byte_offset, remainder = frame_index.locate(start)
+                before_options = f"-skip_initial_bytes {byte_offset}"
+                options = f"-vn -ss {remainder:.3f}"
+            else:
+                before_options = f"-ss {start:.3f}"
 
-        return cls(discord.FFmpegPCMAudio(str(song_filepath)))
+        if song_metadata.trim_end:
+            options += f" -t {max(song_metadata.trim_end - start, 0):.3f}"
+
+        try:
+            audio = discord.FFmpegPCMAudio(read_filepath, before_options=before_options, options=options)
+        except discord.ClientException:
+            governor.release(priority)
+            raise
+
+        tune_process(audio._process.pid, priority)
+
+        # Prefetching reads as fast as it can anyway, so only live playback is read ahead.
+        if priority == Priority.LIVE and read_ahead_frames:
+            audio = BufferedPCMAudio(audio, read_ahead_frames)
+
+        source = cls(audio, start=start)
+        source.governor_priority = priority
+
+        return source
 
     @classmethod
     async def create_yt_source(cls, temp_filepath: str):
         """Creates a source for a temporarily downloaded YouTube video"""
         return cls(discord.FFmpegPCMAudio(str(temp_filepath)))
+
+
+@functools.lru_cache
+def get_fade_curves(fade_frames: int) -> tuple[np.ndarray, np.ndarray]:
+    """Returns the equal-power gains of the incoming and outgoing songs for every sample of a crossfade, one row \
+    per frame. They're computed once per fade length and shared by every guild."""
+    progress = (np.arange(fade_frames * discord.opus.Encoder.SAMPLES_PER_FRAME) + 0.5) / \
+        (fade_frames * discord.opus.Encoder.SAMPLES_PER_FRAME)
+    progress = np.repeat(progress, discord.opus.Encoder.CHANNELS).reshape(fade_frames, frame_samples)
+
+    gains_in = np.sin(progress * np.pi / 2).astype(np.float32)
+    gains_out = np.cos(progress * np.pi / 2).astype(np.float32)
+
+    return gains_in, gains_out
+
+
+class CrossfadeMixer(discord.AudioSource):
+    """Plays songs back to back, overlapping the end of each song with the start of the next. \
+    Shortly before a song's fade would start, on_fade is called so the next song can be handed over in time with \
+    crossfade_to, and on_start is called with the next song once it starts being heard. Without a next song, or \
+    with crossfading turned off, the song simply plays to its end."""
+
+    def __init__(self, source: SongSource, end_position: float, fade_seconds: float, lead_seconds: float,
+                 on_fade: Callable[['CrossfadeMixer'], None], on_start: Callable[[SongSource], None]) -> None:
+        self.fade_frames = int(fade_seconds / frame_seconds)
+        self.lead_seconds = lead_seconds
+        self.on_fade = on_fade
+        self.on_start = on_start
+
+        self.source = source
+        self.incoming: Optional[SongSource] = None
+        self.incoming_end = 0.0
+        self.fade_index = 0
+        self.ended = False
+        self._set_end(end_position)
+
+        # Mixing reuses the same buffers for every frame.
+        self._mix = np.empty(frame_samples, dtype=np.float32)
+        self._scratch = np.empty(frame_samples, dtype=np.float32)
+        self._output = np.empty(frame_samples, dtype=np.int16)
+        self._lock = threading.Lock()
+
+    def _set_end(self, end_position: float) -> None:
+        self.fade_position = end_position - self.fade_frames * frame_seconds
+        self.signal_position = self.fade_position - self.lead_seconds
+        self.signalled = False
+
+    @property
+    def is_fading(self) -> bool:
+        return self.incoming is not None and self.fade_index > 0
+
+    def crossfade_to(self, source: SongSource, end_position: float) -> bool:
+        """Hands over the next song, which starts fading in at the current song's fade position. \
+        Returns False if the mixer can't take it, in which case the song has to be played on its own."""
+        with self._lock:
+            if self.ended or self.incoming is not None or not self.fade_frames:
+                return False
+
+            self.incoming = source
+            self.incoming_end = end_position
+            return True
+
+    def cancel_fade(self) -> bool:
+        """Takes back the song handed over with crossfade_to, so the playing song plays on to its end. \
+        Returns False if it can't be taken back because it has already started fading in."""
+        with self._lock:
+            if self.incoming is None or self.fade_index > 0:
+                return False
+
+            self.incoming = None
+            return True
+
+    def read(self) -> bytes:
+        with self._lock:
+            if self.ended:
+                return b''
+
+            if self.incoming is None or (self.fade_index == 0 and self.source.position < self.fade_position):
+                data = self.source.read()
+                if data:
+                    if self.fade_frames and not self.signalled and self.source.position >= self.signal_position:
+                        self.signalled = True
+                        self.on_fade(self)
+                    return data
+
+                if self.incoming is None:
+                    self.ended = True
+                    return b''
+
+            return self._read_fade()
+
+    def skip(self) -> bool:
+        """Cuts the playing song short and carries on with the song handed over for the fade, without waiting for \
+        it. Returns False if no song has been handed over, in which case the mixer itself has to be stopped."""
+        with self._lock:
+            if self.ended or self.incoming is None:
+                return False
+
+            if self.fade_index == 0:
+                self.on_start(self.incoming)
+            if self.source is not None:
+                self.source.cleanup()
+                self.source = None
+            self._promote_incoming()
+
+            return True
+
+    def _read_fade(self) -> bytes:
+        if self.fade_index == 0:
+            self.on_start(self.incoming)
+
+        incoming = self.incoming.read()
+        outgoing = self.source.read() if self.source is not None else b''
+        if not outgoing and self.source is not None:
+            self.source.cleanup()
+            self.source = None
+
+        gains_in, gains_out = get_fade_curves(self.fade_frames)
+        gain_in, gain_out = gains_in[self.fade_index], gains_out[self.fade_index]
+        self.fade_index += 1
+
+        if len(incoming) == self._output.nbytes:
+            np.multiply(np.frombuffer(incoming, dtype=np.int16), gain_in, out=self._mix)
+        else:
+            self._mix.fill(0)
+        if len(outgoing) == self._output.nbytes:
+            np.multiply(np.frombuffer(outgoing, dtype=np.int16), gain_out, out=self._scratch)
+            self._mix += self._scratch
+
+        # Once the fade is over, or the incoming song is already over, it becomes the song being played.
+        if self.fade_index >= self.fade_frames or not incoming:
+            self._promote_incoming()
+            if not incoming and not outgoing:
+                self.ended = True
+                return b''
+
+        np.clip(self._mix, -32768, 32767, out=self._mix)
+        self._output[:] = self._mix
+
+        return self._output.tobytes()
+
+    def _promote_incoming(self) -> None:
+        if self.source is not None:
+            # The fade ends at the song's expected end, so there's normally nothing left. Whatever is left is still
+            # read, so the song counts as played through and its recording can be cached.
+            self.source.drain(drain_frames)
+            self.source.cleanup()
+
+        self.source, self.incoming = self.incoming, None
+        self.fade_index = 0
+        self._set_end(self.incoming_end)
+
+    def cleanup(self) -> None:
+        with self._lock:
+            self.ended = True
+            for source in (self.source, self.incoming):
+                if source is not None:
+                    source.cleanup()
+
+
+def preload_song(song_id: int) -> None:
+    """Decodes a whole song and stores it in the audio cache. Blocks, so it is run in a worker thread."""
+    governor.acquire(Priority.PREFETCH)
+    source = SongSource.create_ffmpeg_source(song_id, main_library.library[song_id].trim_start, Priority.PREFETCH)
+    source.start_recording(song_id)
+    try:
+        while source.read():
+            pass
+    finally:
+        source.cleanup()
+
+
+async def warm_audio_cache(song_ids: list[int]) -> None:
+    """Preloads songs into the audio cache one at a time, in the background."""
+    for song_id in song_ids:
+        if song_id not in main_library.library or not audio_cache.should_admit(song_id):
+            continue
+
+        try:
+            await asyncio.to_thread(preload_song, song_id)
+        except Exception:
+            logger.error(f"Failed to preload song {song_id} into the audio cache.", exc_info=True)
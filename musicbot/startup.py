@@ -0,0 +1,62 @@
+import time
+from contextlib import contextmanager
+
+from logs import loggers
+
+logger = loggers.createLogger('main.startup')
+
+
+class StartupTimer:
+    """Times the bot's startup as a sequence of stages, ex. imports, cogs and gateway, each closed with lap(). \
+    Phases timed anywhere in the code with phase(), ex. the library scan, are reported under the stage they ran in."""
+
+    def __init__(self) -> None:
+        self.start = time.perf_counter()
+        self.last_lap = self.start
+        self.laps: list[tuple[str, float, float]] = []
+        self.phases: list[tuple[str, float, float]] = []
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start
+
+    def lap(self, name: str) -> float:
+        """Ends the current stage and returns how long it took."""
+        now = time.perf_counter()
+        self.laps.append((name, self.last_lap, now))
+        self.last_lap = now
+
+        return now - self.laps[-1][1]
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, start, time.perf_counter()))
+
+    def get_lap_seconds(self, excluded: tuple[str, ...] = ()) -> float:
+        return sum(end - start for name, start, end in self.laps if name not in excluded)
+
+    def report(self) -> str:
+        lines = [f"Startup took {self.get_lap_seconds():.2f}s:"]
+        for lap_name, lap_start, lap_end in self.laps:
+            lines.append(f"  {lap_name:<10} {lap_end - lap_start:6.2f}s")
+            for name, start, end in self.phases:
+                if lap_start <= start < lap_end:
+                    lines.append(f"    {name:<8} {end - start:6.2f}s")
+
+        return '\n'.join(lines)
+
+    def check_budget(self, budget: float, excluded: tuple[str, ...] = ()) -> bool:
+        """Returns whether startup, without the excluded stages, stayed within a budget in seconds."""
+        seconds = self.get_lap_seconds(excluded)
+        if seconds > budget:
+            logger.warning(f"Startup took {seconds:.2f}s, over its budget of {budget:.2f}s.")
+            return False
+
+        return True
+
+
+startup_timer = StartupTimer()